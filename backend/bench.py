@@ -0,0 +1,311 @@
+"""Benchmarks for the inference, association and matching hot paths.
+
+    python bench.py [--sizes 10 100 500 2000] [--repeat 20] [--out run.json] [--compare baseline.json]
+
+Runs offline on cpu: images, masks and lesion sets are synthetic, and unless
+--real-models is given the predictors are stubs returning synthetic
+instances, so the model stages time only the post-processing around them.
+Each stage reports p50/p99 latency and two peaks for one run: Python/numpy
+allocations seen by tracemalloc, and process RSS growth sampled from a helper
+thread, which also covers torch's allocator (masks, model activations).
+--out saves them as JSON and --compare prints the change against an earlier
+run.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import numpy as np
+
+# the service module builds a db engine on import; benchmarks never touch it
+os.environ.setdefault("DB_URL", "sqlite://")
+
+import torch
+from detectron2.structures import Boxes, Instances
+from PIL import Image as Image2
+from matching import dense_assignment, sparse_assignment
+from registry import registry, LESION_MODEL, SEGMENTATION_MODEL
+from service import (
+    DetectedObject,
+    JsonLesion,
+    Lesion,
+    associateLesionToBodyPart,
+    decodeImage,
+    isInside,
+    map_and_match,
+    maskStats,
+    predictObjs,
+)
+
+PHOTO_SIZE = (4032, 3024)  # 12 MP phone photo, width x height
+# the models' INPUT.MIN_SIZE_TEST / MAX_SIZE_TEST and TEST.DETECTIONS_PER_IMAGE
+MIN_SIZE_TEST, MAX_SIZE_TEST = 800, 1333
+DETECTIONS_PER_IMAGE = 100
+
+
+def associateLoop(lesions, bodyParts):
+    # the original nested-loop association, kept as the reference
+    lesion_list = []
+    for lesion in lesions:
+        part = -1
+        for bodyPart in bodyParts:
+            if isInside(lesion.centroid, lesion.bounding_box, bodyPart.bounding_box):
+                part = bodyPart.class_tag
+                break
+        lesion_list.append(Lesion(lesion.object_number, lesion.area, lesion.centroid, lesion.bounding_box, part))
+    return lesion_list
+
+
+def detectedObject(i, box, class_tag):
+    r0, c0, r1, c1 = box
+    centroid = ((r0 + r1) / 2, (c0 + c1) / 2)
+    return DetectedObject(i + 1, (r1 - r0) * (c1 - c0), centroid, box, class_tag)
+
+
+def bodyPartBoxes(height, width):
+    # torso, legs and arms laid out roughly like a standing full-body photo
+    boxes = [
+        (height * 0.15, width * 0.3, height * 0.55, width * 0.7),
+        (height * 0.5, width * 0.3, height * 1.0, width * 0.5),
+        (height * 0.15, width * 0.1, height * 0.6, width * 0.3),
+        (height * 0.5, width * 0.5, height * 1.0, width * 0.7),
+        (height * 0.15, width * 0.7, height * 0.6, width * 0.9),
+    ]
+    return [tuple(int(v) for v in b) for b in boxes], [0, 1, 2, 3, 2]
+
+
+def lesionBoxes(n, height, width, rng):
+    size = rng.integers(4, 40, size=(n, 2))
+    r0 = rng.integers(0, height - 40, size=n)
+    c0 = rng.integers(0, width - 40, size=n)
+    return np.stack([r0, c0, r0 + size[:, 0], c0 + size[:, 1]], axis=1)
+
+
+def syntheticBodyParts(height, width):
+    boxes, tags = bodyPartBoxes(height, width)
+    return [detectedObject(i, b, t) for i, (b, t) in enumerate(zip(boxes, tags))]
+
+
+def syntheticLesions(n, height, width, rng):
+    return [detectedObject(i, tuple(int(v) for v in b), 0) for i, b in enumerate(lesionBoxes(n, height, width, rng))]
+
+
+def syntheticLesionPair(n, rng, jitter=3.0):
+    # the same lesions photographed twice: small jitter, a few lost/new ones
+    width, height = PHOTO_SIZE
+    a = rng.uniform(0, [width, height], size=(n, 2))
+    b = a + rng.normal(0, jitter, size=a.shape)
+    kept = rng.random(n) > 0.05
+    b = np.concatenate([b[kept], rng.uniform(0, [width, height], size=(n // 20, 2))])
+    parts_a = rng.integers(0, 4, size=n)
+    parts_b = np.concatenate([parts_a[kept], rng.integers(0, 4, size=n // 20)])
+    l1 = [JsonLesion(i + 1, x, y, 5.0, int(p)) for i, ((x, y), p) in enumerate(zip(a, parts_a))]
+    l2 = [JsonLesion(i + 1, x, y, 5.0, int(p)) for i, ((x, y), p) in enumerate(zip(b, parts_b))]
+    return a, b, l1, l2
+
+
+def syntheticPhoto(rng) -> bytes:
+    # smooth skin-ish gradient with noise, encoded like a phone camera would
+    width, height = PHOTO_SIZE
+    y, x = np.mgrid[0:height:8, 0:width:8]
+    small = np.stack([180 + 40 * np.sin(x / 300), 140 + 30 * np.cos(y / 200), 120 + 0 * x], axis=2)
+    small = small + rng.normal(0, 8, size=small.shape)
+    pil = Image2.fromarray(np.clip(small, 0, 255).astype(np.uint8)).resize(PHOTO_SIZE)
+    buf = io.BytesIO()
+    pil.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def modelSize(width, height):
+    scale = min(MIN_SIZE_TEST / min(width, height), MAX_SIZE_TEST / max(width, height))
+    return math.ceil(width * scale), math.ceil(height * scale)
+
+
+def syntheticInstances(boxes, classes, height, width, rng):
+    masks = torch.zeros((len(boxes), height, width), dtype=torch.bool)
+    for i, (r0, c0, r1, c1) in enumerate(boxes):
+        masks[i, r0:r1, c0:c1] = True
+    instances = Instances((height, width))
+    instances.pred_masks = masks
+    instances.pred_boxes = Boxes(
+        torch.tensor([[c0, r0, c1, r1] for r0, c0, r1, c1 in boxes], dtype=torch.float32).reshape(-1, 4)
+    )
+    instances.pred_classes = torch.tensor(classes, dtype=torch.int64)
+    instances.scores = torch.tensor(rng.uniform(0.2, 1.0, size=len(boxes)), dtype=torch.float32)
+    return instances
+
+
+class StubPredictor:
+    """Stands in for DefaultPredictor, returning the same instances every call."""
+
+    def __init__(self, instances):
+        self.instances = instances
+
+    def __call__(self, im):
+        return {"instances": self.instances}
+
+
+def currentRss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # not linux: only the high-water mark is available, so a stage that
+        # stays below an earlier peak reads as 0
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def peakRss(fn, interval=0.001) -> int:
+    # RSS growth above the starting point while fn runs; large torch
+    # tensors are mmapped, so they show up here and are released on free
+    base = currentRss()
+    peak = [base]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], currentRss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        fn()
+    finally:
+        done.set()
+        sampler.join()
+    return max(peak[0], currentRss()) - base
+
+
+def measure(fn, repeat):
+    fn()  # warm up
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+
+    # memory in a separate run, tracemalloc slows everything down
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss = peakRss(fn)
+
+    samples = np.array(samples)
+    return {
+        "p50": float(np.percentile(samples, 50)),
+        "p99": float(np.percentile(samples, 99)),
+        "mean": float(samples.mean()),
+        "peakBytes": int(peak),
+        "peakRssBytes": int(rss),
+    }
+
+
+def run(sizes, repeat, realModels=False, seed=0):
+    rng = np.random.default_rng(seed)
+    results = []
+
+    def record(stage, n, fn, **extra):
+        res = {"stage": stage, "n": n, **measure(fn, repeat), **extra}
+        results.append(res)
+        print(
+            f"{stage:20s} n={'-' if n is None else n:>5}  p50 {res['p50'] * 1e3:9.2f} ms  "
+            f"p99 {res['p99'] * 1e3:9.2f} ms  peak {res['peakBytes'] / 2**20:8.1f} MiB  "
+            f"rss {res['peakRssBytes'] / 2**20:8.1f} MiB"
+        )
+
+    photo = syntheticPhoto(rng)
+    record("decodeFull", None, lambda: decodeImage(io.BytesIO(photo)))
+    record("decode", None, lambda: decodeImage(io.BytesIO(photo), modelSize))
+    im, scale = decodeImage(io.BytesIO(photo), modelSize)
+    height, width = im.shape[:2]
+
+    partBoxes, partTags = bodyPartBoxes(height, width)
+    segmentation = StubPredictor(syntheticInstances(partBoxes, partTags, height, width, rng))
+    if realModels:
+        segmentation = registry.get(SEGMENTATION_MODEL)
+        record("lesionModel", None, lambda: predictObjs(registry.get(LESION_MODEL), im))
+    record("segmentationModel", None, lambda: predictObjs(segmentation, im))
+    bodyParts = predictObjs(segmentation, im)
+
+    for n in sizes:
+        # the detector never returns more than DETECTIONS_PER_IMAGE instances
+        k = min(n, DETECTIONS_PER_IMAGE)
+        boxes = lesionBoxes(k, height, width, rng).tolist()
+        instances = syntheticInstances(boxes, [0] * k, height, width, rng)
+        if not realModels:
+            record("lesionModel", n, lambda: predictObjs(StubPredictor(instances), im), instances=k)
+        record("maskStats", n, lambda: maskStats(instances.pred_masks), instances=k)
+
+        lesions = syntheticLesions(n, height, width, rng)
+        expected = [(l.id, l.body_part) for l in associateLoop(lesions, bodyParts)]
+        actual = [(l.id, l.body_part) for l in associateLesionToBodyPart(lesions, bodyParts, None)]
+        assert expected == actual, f"vectorized association differs at n={n}"
+        record("associationLoop", n, lambda: associateLoop(lesions, bodyParts))
+        record("association", n, lambda: associateLesionToBodyPart(lesions, bodyParts, None))
+
+        a, b, l1, l2 = syntheticLesionPair(n, rng)
+        dense = dense_assignment(a, b)
+        sparse = sparse_assignment(a, b, 20.0)
+        keep = dense[2] <= 20.0
+        expected = set(zip(dense[0][keep].tolist(), dense[1][keep].tolist()))
+        agreement = len(expected & set(zip(sparse[0].tolist(), sparse[1].tolist()))) / max(len(expected), 1)
+        record("matchingDense", n, lambda: dense_assignment(a, b))
+        record("matchingSparse", n, lambda: sparse_assignment(a, b, 20.0), agreement=agreement)
+        record(
+            "mapAndMatch", n, lambda: map_and_match(l1, l2, 20.0, "sparse", by_body_part=True, register=True)
+        )
+
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "threads": torch.get_num_threads(),
+            "realModels": realModels,
+            "repeat": repeat,
+            "decodeScale": scale,
+        },
+        "results": results,
+    }
+
+
+def compare(current, baselinePath):
+    with open(baselinePath) as f:
+        baseline = json.load(f)
+    old = {(r["stage"], r["n"]): r for r in baseline["results"]}
+    print(f"\ncompared to {baselinePath} ({baseline['meta']['time']}), p50 new/old:")
+    for r in current["results"]:
+        prev = old.get((r["stage"], r["n"]))
+        if prev is None or prev["p50"] == 0:
+            continue
+        ratio = r["p50"] / prev["p50"]
+        flag = "  slower" if ratio > 1.1 else ("  faster" if ratio < 0.9 else "")
+        print(f"{r['stage']:20s} n={'-' if r['n'] is None else r['n']:>5}  x{ratio:5.2f}{flag}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 2000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--real-models", action="store_true", help="load the real predictors")
+    parser.add_argument("--out", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run")
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.repeat, args.real_models)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(report, args.compare)
@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+# db.py and storage.py read these on import: an in-memory sqlite database and
+# filesystem storage, so the tests run offline
+os.environ["DB_URL"] = "sqlite://"
+os.environ["STORAGE_BACKEND"] = "fs"
+os.environ["STORAGE_ROOT"] = tempfile.mkdtemp(prefix="storage-")
+os.environ["CELERY_ALWAYS_EAGER"] = "1"
+
+import pytest
+from flask import Flask
+
+
+@pytest.fixture(autouse=True)
+def database():
+    from db import Base, engine
+
+    Base.metadata.create_all(engine)
+    yield engine
+    Base.metadata.drop_all(engine)
+
+
+@pytest.fixture
+def app():
+    from db import init_app
+
+    app = Flask(__name__)
+    init_app(app)
+    return app
+
+
+@pytest.fixture
+def patient():
+    from service import createPatient, createUser
+
+    user = createUser("doctor", "doctor", "google-1")
+    return createPatient("patient", user.id)
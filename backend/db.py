@@ -1,17 +1,57 @@
+import datetime
 import logging
-from sqlalchemy import create_engine, String, ForeignKey, Identity, DateTime, func
+from contextlib import contextmanager
+from flask import Flask, g, has_app_context
+from sqlalchemy import create_engine, event, inspect, text, String, ForeignKey, Identity, DateTime, Index, func
 from sqlalchemy.orm import DeclarativeBase, Session, Mapped, mapped_column, relationship
-from typing import List
+from typing import List, Optional
 from dotenv import load_dotenv
+from metrics import count_call
 import os
 
 load_dotenv()
-connection_string = (
-    "postgresql+psycopg2://postgres.ncqjhzqhntwmwftyfmkz:"
-    + os.getenv("DB_PASSWORD")
-    + "@aws-0-us-west-1.pooler.supabase.com:5432/postgres"
-)
-engine = create_engine(connection_string, echo=True)
+
+
+def connectionString():
+    # DB_URL overrides the default, e.g. sqlite:///test.db for local runs
+    if os.getenv("DB_URL"):
+        return os.getenv("DB_URL")
+    return (
+        "postgresql+psycopg2://postgres.ncqjhzqhntwmwftyfmkz:"
+        + os.getenv("DB_PASSWORD", "")
+        + "@aws-0-us-west-1.pooler.supabase.com:5432/postgres"
+    )
+
+
+def engineOptions(url: str):
+    options = {
+        "echo": os.getenv("DB_ECHO", "0") == "1",
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1",
+    }
+    if url.startswith("sqlite"):
+        return options
+
+    options["pool_size"] = int(os.getenv("DB_POOL_SIZE", "5"))
+    options["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    options["pool_timeout"] = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+    # recycle before the pooler drops idle connections
+    options["pool_recycle"] = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    if os.getenv("DB_STATEMENT_TIMEOUT_MS"):
+        options["connect_args"] = {
+            "options": "-c statement_timeout=" + os.getenv("DB_STATEMENT_TIMEOUT_MS")
+        }
+    return options
+
+
+connection_string = connectionString()
+engine = create_engine(connection_string, **engineOptions(connection_string))
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def countQuery(conn, cursor, statement, parameters, context, executemany):
+    # labelled by statement kind (select, insert, ...), executemany counts once
+    words = statement.split(None, 1)
+    count_call("db", words[0].lower() if words else "")
 
 
 class Base(DeclarativeBase):
@@ -20,13 +60,14 @@ class Base(DeclarativeBase):
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (Index("ix_users_googleId", "googleId", unique=True),)
 
     role: Mapped[str] = mapped_column(String(50))
     name: Mapped[str] = mapped_column(String(50))
     googleId: Mapped[str] = mapped_column(String(50))
     id: Mapped[int] = mapped_column(primary_key=True)
     patients: Mapped[List["Patient"]] = relationship(
-        back_populates="owner", cascade="all, delete-orphan", lazy="joined"
+        back_populates="owner", cascade="all, delete-orphan"
     )
 
 
@@ -35,38 +76,150 @@ class Patient(Base):
 
     name: Mapped[str] = mapped_column(String(50))
     id: Mapped[int] = mapped_column(primary_key=True)
-    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
     owner: Mapped["User"] = relationship(back_populates="patients")
 
     images: Mapped[List["Image"]] = relationship(
-        back_populates="patient", cascade="all, delete-orphan", lazy="joined"
+        back_populates="patient", cascade="all, delete-orphan"
     )
 
     def __repr__(self):
         return f"Patient(id={self.id}, name={self.name}, owner{self.owner})"
 
 
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
 class Image(Base):
     __tablename__ = "image"
+    # serves both lookups by patient and the patient timeline ordering
+    __table_args__ = (Index("ix_image_patient_timestamp", "patient_id", "timestamp", "id"),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     imageUrl: Mapped[String] = mapped_column(String(1000))
-    timestamp: Mapped[DateTime] = mapped_column(DateTime(), server_default=func.now())
+    # set in python so stored and bound values share one format; sqlite's
+    # CURRENT_TIMESTAMP has no microseconds and compares unequal as a string
+    timestamp: Mapped[DateTime] = mapped_column(DateTime(), default=utcnow, server_default=func.now())
     patient_id: Mapped[int] = mapped_column(ForeignKey("patients.id"))
+    # sha256 of the uploaded bytes, identical uploads share one S3 object
+    contentHash: Mapped[Optional[str]] = mapped_column(String(64), index=True, nullable=True)
+    # registry version of the models that produced this image's lesions
+    lesionModelVersion: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
 
     patient: Mapped["Patient"] = relationship(back_populates="images")
+    lesions: Mapped[List["DetectedLesion"]] = relationship(
+        back_populates="image", cascade="all, delete-orphan"
+    )
 
     def __repr__(self):
         return f"Image(id={self.id}, url={self.imageUrl}, patient={self.patient})"
 
 
-def getSession():
+class DetectedLesion(Base):
+    __tablename__ = "lesion"
+    __table_args__ = (Index("ix_lesion_image_bodypart", "image_id", "bodyPart"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    image_id: Mapped[int] = mapped_column(ForeignKey("image.id", ondelete="CASCADE"))
+    # object number within the image, the "id" clients see
+    lesionId: Mapped[int] = mapped_column()
+    x: Mapped[float] = mapped_column()
+    y: Mapped[float] = mapped_column()
+    radius: Mapped[float] = mapped_column()
+    bodyPart: Mapped[int] = mapped_column()
+    area: Mapped[float] = mapped_column()
+    # (min_row, min_col, max_row, max_col), max exclusive
+    bboxMinRow: Mapped[int] = mapped_column()
+    bboxMinCol: Mapped[int] = mapped_column()
+    bboxMaxRow: Mapped[int] = mapped_column()
+    bboxMaxCol: Mapped[int] = mapped_column()
+    # same lesion across a patient's images, assigned by tracking
+    trackId: Mapped[Optional[int]] = mapped_column(nullable=True)
+
+    image: Mapped["Image"] = relationship(back_populates="lesions")
+
+    def __repr__(self):
+        return f"DetectedLesion(id={self.id}, image={self.image_id}, lesion={self.lesionId})"
+
+
+def newSession():
     s = Session(engine)
     s.expire_on_commit = False
     return s
 
 
+@contextmanager
+def getSession():
+    """Session for one unit of work.
+
+    Inside a Flask request (or celery task) every call shares one session,
+    which is closed when the app context tears down. Outside of one, e.g. on
+    helper threads, each call gets its own short-lived session.
+    """
+    if not has_app_context():
+        with newSession() as s:
+            yield s
+        return
+
+    s = g.get("db_session")
+    if s is None:
+        s = g.db_session = newSession()
+    try:
+        yield s
+    except Exception:
+        s.rollback()
+        raise
+
+
+def closeSession(exc=None):
+    s = g.pop("db_session", None)
+    if s is not None:
+        s.close()
+
+
+def init_app(app: Flask):
+    app.teardown_appcontext(closeSession)
+
+
+def migrate():
+    # create_all skips tables that already exist, including their columns and
+    # indexes, so add any nullable column or index declared since the table
+    # was created
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            with engine.begin() as conn:
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} "
+                        + column.type.compile(engine.dialect)
+                    )
+                )
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(engine, checkfirst=True)
+            except Exception as e:
+                # e.g. duplicate googleIds already in the table
+                logging.getLogger(__name__).warning("could not create index %s: %s", index.name, e)
+
+    if engine.dialect.name == "sqlite" and inspector.has_table("image"):
+        # rows stamped by CURRENT_TIMESTAMP lack the microseconds sqlalchemy binds
+        with engine.begin() as conn:
+            conn.execute(
+                text("UPDATE image SET timestamp = timestamp || '.000000' WHERE length(timestamp) = 19")
+            )
+
+
 def init():
-    logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
     # Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
+    migrate()
@@ -0,0 +1,120 @@
+"""Export the predictors to TorchScript for cpu inference.
+
+    python export.py [--quantize] --sample IMAGE
+    python export.py --check IMAGE [IMAGE ...]
+
+Writes models/<model>/model.ts (+ .schema), which the registry serves instead
+of the eager detectron2 model. The sample should be a real photo with lesions:
+tracing follows the path the sample takes. --check compares the exported model
+against the eager one on the given images and fails when they disagree, when
+there is no export, or when no image has detections to compare.
+"""
+import argparse
+import os
+import pickle
+import sys
+import numpy as np
+import torch
+from detectron2.export import TracingAdapter
+from detectron2.structures import pairwise_iou
+from PIL import Image as Image2
+from registry import registry, build_predictor, ModelSpec, TracedPredictor
+
+# exported models are traced for and served on cpu, so trace and compare there
+os.environ["MODEL_DEVICE"] = "cpu"
+
+
+def sampleImages(paths):
+    return [np.ascontiguousarray(np.asarray(Image2.open(p).convert("RGB"))[:, :, ::-1]) for p in paths]
+
+
+def export(spec: ModelSpec, sample, quantize: bool):
+    predictor, cfg = build_predictor(spec, exported=False)
+    if len(predictor(sample)["instances"]) == 0:
+        print(
+            f"warning: {spec.name} finds nothing on the sample, trace with an image that has detections",
+            file=sys.stderr,
+        )
+    model = predictor.model.to("cpu").eval()
+    if quantize:
+        # int8 weights for the fully connected box/mask heads
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    image = predictor.aug.get_transform(sample).apply_image(sample)
+    image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+
+    def inference(model, inputs):
+        # postprocessing (mask pasting) runs outside the traced graph
+        instances = model.inference(inputs, do_postprocess=False)[0]
+        return [{"instances": instances}]
+
+    adapter = TracingAdapter(model, [{"image": image}], inference)
+    with torch.no_grad():
+        traced = torch.jit.trace(adapter, adapter.flattened_inputs, check_trace=False)
+    traced.save(spec.export_path)
+    with open(spec.schema_path, "wb") as f:
+        pickle.dump(adapter.outputs_schema, f)
+    print(f"exported {spec.name} to {spec.export_path}")
+
+
+def check(spec: ModelSpec, images, min_iou: float, max_score_diff: float) -> bool:
+    if not spec.has_export():
+        print(f"{spec.name}: no export at {spec.export_path} (or older than the weights)")
+        return False
+    eager, _ = build_predictor(spec, exported=False)
+    exported, _ = build_predictor(spec, exported=True)
+    if not isinstance(exported, TracedPredictor):
+        print(f"{spec.name}: the registry did not load the export")
+        return False
+    ok = True
+    compared = 0
+    for i, im in enumerate(images):
+        a = eager(im)["instances"].to("cpu")
+        b = exported(im)["instances"].to("cpu")
+        if len(a) == 0 and len(b) == 0:
+            print(f"{spec.name} image {i}: no detections in either model")
+            continue
+        if len(a) == 0 or len(b) == 0:
+            print(f"{spec.name} image {i}: {len(a)} eager vs {len(b)} exported detections")
+            ok = False
+            continue
+        compared += 1
+
+        # best exported match for every eager detection
+        iou = pairwise_iou(a.pred_boxes, b.pred_boxes)
+        best_iou, best = iou.max(dim=1)
+        score_diff = (a.scores - b.scores[best]).abs()
+        same_class = a.pred_classes == b.pred_classes[best]
+        matched = (best_iou >= min_iou) & same_class & (score_diff <= max_score_diff)
+        print(
+            f"{spec.name} image {i}: {len(a)} eager vs {len(b)} exported, "
+            f"{int(matched.sum())} matched, mean iou {best_iou.mean():.3f}, "
+            f"max score diff {score_diff.max():.3f}"
+        )
+        ok = ok and bool(matched.all()) and len(a) == len(b)
+    if compared == 0:
+        print(f"{spec.name}: no detections on any image, nothing was compared")
+        return False
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quantize", action="store_true", help="dynamic int8 quantization")
+    parser.add_argument("--sample", help="image to trace with, one with detections")
+    parser.add_argument("--check", nargs="+", metavar="IMAGE", help="parity check only")
+    parser.add_argument("--min-iou", type=float, default=0.9)
+    parser.add_argument("--max-score-diff", type=float, default=0.05)
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    if args.check is not None:
+        images = sampleImages(args.check)
+        results = [check(spec, images, args.min_iou, args.max_score_diff) for spec in registry.specs.values()]
+        sys.exit(0 if all(results) else 1)
+
+    if args.sample is None:
+        parser.error("--sample is required to export")
+    sample = sampleImages([args.sample])[0]
+    for spec in registry.specs.values():
+        export(spec, sample, args.quantize)
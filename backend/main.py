@@ -1,26 +1,33 @@
 import datetime
 import json
-import threading
+import logging
 from flask import Flask, Response, jsonify, redirect, request, session
 from dotenv import load_dotenv
 from auth import SessionUser
 from api import GetUserResponse, PatientData
-from db import init, getSession, User, Patient, Image
+from db import init, init_app, getSession, User, Patient, Image
 from service import (
-    JsonLesion,
-    createImage,
-    downloadLesionInfo,
+    createAndUploadImage,
+    reuseLesions,
     getImageUrl,
-    getLesions,
-    map_and_match,
-    uploadImage,
+    matchImages,
+    MATCH_THRESHOLD,
+    MATCH_REGISTER,
+    getLesionSet,
+    cacheStats,
+    uploadStats,
+    signerStats,
+    getImageUrls,
     getUser,
     createUser,
     getUserGoogle,
     getPatient,
+    getPatientImages,
+    getPatientTracks,
+    hasUntrackedLesions,
+    getUserPatients,
     getImage,
     createPatient,
-    uploadLesionInfo,
 )
 from flask_login import (
     LoginManager,
@@ -33,8 +40,13 @@ from oauthlib.oauth2 import WebApplicationClient
 import os
 import requests
 from flask_cors import CORS
+from registry import registry
+import metrics
+from bkg import celery_init_app
+from tasks import enqueueLesions, enqueueLesionsBatch, enqueueTracking, lesionTaskStatus, taskStatus
 
 load_dotenv()
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
@@ -47,13 +59,33 @@ app.config["SESSION_COOKIE_DOMAIN"] = "localhost"
 app.config["SESSION_COOKIE_SAMESITE"] = "None"
 app.config["SESSION_COOKIE_SECURE"] = True
 
+app.config["CELERY"] = {
+    # without a broker, tasks run on a background pool in this process (see
+    # tasks.py) so everything works without redis
+    "broker_url": os.getenv("CELERY_BROKER_URL", "memory://"),
+    "result_backend": os.getenv("CELERY_RESULT_BACKEND", "cache+memory://"),
+    # run tasks synchronously in the caller, for tests
+    "task_always_eager": os.getenv("CELERY_ALWAYS_EAGER") == "1",
+    "task_store_eager_result": True,
+    "task_track_started": True,
+    "task_acks_late": True,
+    "worker_concurrency": int(os.getenv("INFERENCE_CONCURRENCY", "2")),
+    "worker_prefetch_multiplier": 1,
+}
+celery_app = celery_init_app(app)
+
 init()
+init_app(app)
+metrics.init_app(app)
+if os.getenv("PRELOAD_MODELS") == "1":
+    registry.preload()
 login_manager = LoginManager()
 login_manager.init_app(app)
 client = WebApplicationClient(os.getenv("GOOGLE_CLIENT_ID"))
 
 
 config = None
+log = logging.getLogger(__name__)
 
 
 @app.before_request
@@ -74,7 +106,7 @@ def load_user(user_id):
     user = getUser(user_id)
     if user == None:
         return SessionUser(None, False, False, False)
-    return SessionUser(getUser(user_id), True, True, False)
+    return SessionUser(user, True, True, False)
 
 
 @app.route("/")
@@ -83,6 +115,37 @@ def hello_world():
     return res
 
 
+@app.route("/cache/stats")
+def cache_stats():
+    return cacheStats()
+
+
+@app.route("/storage/stats")
+def storage_stats():
+    return {"uploads": uploadStats(), "presign": signerStats()}
+
+
+# Prometheus text format, for this process (a separate celery worker keeps its
+# own task and stage metrics)
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+# folded stacks of a request made with ?profile=1, see the X-Profile-Id header
+@app.route("/metrics/profile/<id>")
+def request_profile(id):
+    profile = metrics.profiles.get(id)
+    if profile == None:
+        return "Not found", 404
+    return Response(profile, mimetype="text/plain")
+
+
+@app.route("/models")
+def model_stats():
+    return registry.stats()
+
+
 # {
 #     "lesions": [
 #         {
@@ -97,7 +160,30 @@ def run_model():
     id = int(request.args.get("id"))
     img = getImage(id)
 
-    return Response(downloadLesionInfo(img), mimetype="application/json")
+    return jsonify(getLesionSet(img))
+
+
+@app.route("/lesion/status")
+def lesion_status():
+    id = int(request.args.get("id"))
+    return {"id": id, "state": lesionTaskStatus(id)}
+
+
+# { "ids": [1, 2, 3] } -> { "ids": [...], "task": "..." }
+@app.post("/lesions/batch")
+def lesions_batch():
+    if not current_user.is_authenticated:
+        return "Not authenticated", 401
+
+    ids = [int(x) for x in request.json["ids"]]
+    task = enqueueLesionsBatch(ids)
+    return {"ids": ids, "task": task.id}
+
+
+@app.get("/lesions/batch")
+def lesions_batch_status():
+    task = request.args.get("task")
+    return {"task": task, "state": taskStatus(task)}
 
 
 @app.route("/match")
@@ -107,17 +193,11 @@ def match2():
     imgA = getImage(idA)
     imgB = getImage(idB)
 
-    infoA = downloadLesionInfo(imgA)
-    infoB = downloadLesionInfo(imgB)
-    arr1 = json.loads(infoA)["lesions"]
-    arr2 = json.loads(infoB)["lesions"]
+    threshold = request.args.get("threshold", MATCH_THRESHOLD, type=float)
+    register = request.args.get("register", "1" if MATCH_REGISTER else "0") == "1"
+    res = matchImages(imgA, imgB, threshold, register)
 
-    l1 = [JsonLesion(x["id"], x["x"], x["y"], x["radius"]) for x in arr1]
-    l2 = [JsonLesion(x["id"], x["x"], x["y"], x["radius"]) for x in arr2]
-    res = map_and_match(l1, l2)
-    asJson = {"mappings": res}
-
-    return jsonify(asJson)
+    return jsonify(res.asJson())
 
 
 # {
@@ -133,8 +213,7 @@ def match2():
 # }
 @app.route("/user")
 def get_user():
-    print(repr(session))
-    print(current_user.get_id())
+    log.debug("session %r, user %s", session, current_user.get_id())
     if not current_user.is_authenticated:
         return "Not authenticated", 401
 
@@ -142,7 +221,9 @@ def get_user():
         "id": current_user.user.id,
         "name": current_user.user.name,
         "role": current_user.user.role,
-        "patients": [{"name": p.name, "id": p.id} for p in current_user.user.patients],
+        "patients": [
+            {"name": p.name, "id": p.id} for p in getUserPatients(current_user.user.id)
+        ],
     }
 
 
@@ -157,38 +238,17 @@ def upload():
     id = int(request.args.get("id"))
 
     file = request.files["file"]
-    key = uploadImage(file)
-    img = createImage(key, id)
-
-    # detect the lesions
-    def process():
-        processLesions(img)
+    img = createAndUploadImage(file, id)
 
-    thread = threading.Thread(target=process)
-    thread.start()
+    # detect the lesions, unless this exact photo was already processed
+    if reuseLesions(img):
+        enqueueTracking(img.patient_id)
+    else:
+        enqueueLesions(img.id)
 
     return {"id": img.id, "url": getImageUrl(img.imageUrl)}
 
 
-def processLesions(img: Image):
-    lesions = getLesions(img.id)
-
-    jsonData = {
-        "lesions": [
-            {
-                "x": float(lesion.centroid[1]),
-                "y": float(lesion.centroid[0]),
-                "radius": float(lesion.get_radius()),
-                "bodyPart": int(lesion.body_part),
-                "id": lesion.id,
-            }
-            for lesion in lesions
-        ]
-    }
-
-    uploadLesionInfo(img.imageUrl + ".lesions.json", json.dumps(jsonData))
-
-
 @app.route("/login")
 def login():
     # Find out what URL to hit for Google login
@@ -210,7 +270,6 @@ def callback():
     code = request.args.get("code")
     google_provider_cfg = get_google_provider_cfg()
     token_endpoint = google_provider_cfg["token_endpoint"]
-    print("hello 4again")
 
     # Prepare and send a request to get tokens! Yay tokens!
     token_url, headers, body = client.prepare_token_request(
@@ -219,7 +278,6 @@ def callback():
         redirect_url=request.base_url,
         code=code,
     )
-    print("hello 2again")
 
     token_response = requests.post(
         token_url,
@@ -230,7 +288,6 @@ def callback():
 
     # Parse the tokens!
     client.parse_request_body_response(json.dumps(token_response.json()))
-    print("hello again")
 
     # Now that you have tokens (yay) let's find and hit the URL
     # from Google that gives you the user's profile information,
@@ -238,7 +295,6 @@ def callback():
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
     uri, headers, body = client.add_token(userinfo_endpoint)
     userinfo_response = requests.get(uri, headers=headers, data=body)
-    print("hello")
 
     # You want to make sure their email is verified.
     # The user authenticated with Google, authorized your
@@ -249,9 +305,9 @@ def callback():
         existing = getUserGoogle(g_id)
         if existing == None:
             # create a user
-            print("creating a user! " + res["given_name"])
+            log.info("creating user %s", res["given_name"])
             existing = createUser(res["given_name"], "doctor", res["sub"])
-        print("logging in " + existing.name)
+        log.info("logging in %s", existing.name)
         login_user(SessionUser(existing, True, True, False))
         return redirect(os.getenv("FRONTEND_LOGIN_REDIRECT"))
     else:
@@ -283,20 +339,52 @@ def patient_id():
     if patient.owner_id != current_user.user.id:
         return "Not found", 404
 
+    # all images unless the client asks for pages
+    limit = request.args.get("limit", type=int)
+    after = request.args.get("after")
+    try:
+        images, cursor = getPatientImages(patient.id, limit, after)
+    except ValueError as e:
+        return str(e), 400
+    urls = getImageUrls([image.imageUrl for image in images])
     return {
         "name": patient.name,
         "id": patient.id,
+        "next": cursor,
         "images": [
             {
-                "url": getImageUrl(image.imageUrl),
+                "url": url,
                 "timestamp": image.timestamp,
                 "id": image.id,
             }
-            for image in patient.images
+            for image, url in zip(images, urls)
         ],
     }
 
 
+# {
+#   "tracks": [
+#     { "trackId": 1, "lesions": [{ "imageId": 0, "timestamp": 0, "id": 0, "x": 0, "y": 0, "radius": 0 }] }
+#   ],
+#   "pending": false
+# }
+@app.get("/patient/tracks")
+def patient_tracks():
+    if not current_user.is_authenticated:
+        return "Not authenticated", 401
+
+    id = int(request.args.get("id"))
+    patient: Patient = getPatient(id)
+    if patient == None or patient.owner_id != current_user.user.id:
+        return "Not found", 404
+
+    # linking writes, so it runs as a task rather than on this request
+    pending = hasUntrackedLesions(patient.id)
+    if pending:
+        enqueueTracking(patient.id)
+    return {"tracks": getPatientTracks(patient.id), "pending": pending}
+
+
 @app.route("/lesions")
 def get_lesion():
     if not current_user.is_authenticated:
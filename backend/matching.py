@@ -0,0 +1,204 @@
+from concurrent.futures import Executor, Future
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+from skimage.measure import ransac
+from skimage.transform import AffineTransform, SimilarityTransform
+
+
+def _empty():
+    return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype=float)
+
+
+def dense_assignment(a: np.ndarray, b: np.ndarray, threshold: float = None):
+    """Min-cost assignment over the full (N,M) distance matrix.
+
+    Returns (rows, cols, distances) like linear_sum_assignment, including
+    pairs farther apart than the threshold.
+    """
+    if len(a) == 0 or len(b) == 0:
+        return _empty()
+    d = cdist(a, b)
+    rows, cols = linear_sum_assignment(d)
+    return rows, cols, d[rows, cols]
+
+
+def sparse_assignment(a: np.ndarray, b: np.ndarray, threshold: float):
+    """Assignment restricted to pairs within `threshold` of each other.
+
+    A KD-tree finds the candidate pairs, which form a bipartite graph; every
+    connected component is solved on its own, so the cost follows the size of
+    the clusters of nearby lesions instead of N*M. Pairs farther apart than
+    the threshold get a cost higher than any set of candidate pairs and are
+    dropped from the result, so every returned pair is within the threshold.
+
+    Each component therefore gets as many within-threshold pairs as possible,
+    then the smallest total distance among those. The dense solver followed
+    by the threshold cut only minimizes total distance, so it can give up a
+    within-threshold pair to make room for an out-of-threshold one, which is
+    then cut. That happens on crowded sets, and also whenever some lesions
+    have no counterpart in the other set. There the two differ, and this one
+    never returns fewer pairs. When every lesion has a counterpart and the
+    lesions are farther apart than the threshold, they agree.
+    """
+    n, m = len(a), len(b)
+    if n == 0 or m == 0:
+        return _empty()
+
+    # ndarray output keeps pairs at distance 0, which a sparse matrix would drop
+    candidates = cKDTree(a).sparse_distance_matrix(cKDTree(b), threshold, output_type="ndarray")
+    if len(candidates) == 0:
+        return _empty()
+
+    # nodes 0..n-1 are lesions in a, n..n+m-1 lesions in b
+    graph = coo_matrix(
+        (np.ones(len(candidates)), (candidates["i"], candidates["j"] + n)), shape=(n + m, n + m)
+    )
+    _, labels = connected_components(graph, directed=False)
+
+    edge_labels = labels[candidates["i"]]
+    order = np.argsort(edge_labels, kind="stable")
+    splits = np.flatnonzero(np.diff(edge_labels[order])) + 1
+
+    rows, cols, dists = [], [], []
+    for edges in np.split(order, splits):
+        ai = np.unique(candidates["i"][edges])
+        bi = np.unique(candidates["j"][edges])
+        if len(ai) == 1 and len(bi) == 1:
+            rows.append(ai)
+            cols.append(bi)
+            dists.append(candidates["v"][edges[:1]])
+            continue
+        sub = cdist(a[ai], b[bi])
+        far = sub > threshold
+        # one pair more within the threshold always beats a lower total distance
+        cost = np.where(far, threshold * min(len(ai), len(bi)) + 1.0, sub)
+        r, c = linear_sum_assignment(cost)
+        keep = ~far[r, c]
+        rows.append(ai[r[keep]])
+        cols.append(bi[c[keep]])
+        dists.append(sub[r[keep], c[keep]])
+
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(dists)
+
+
+def solve_assignment(a: np.ndarray, b: np.ndarray, threshold: float, method: str = "sparse"):
+    if method == "dense":
+        return dense_assignment(a, b, threshold)
+    if method == "sparse":
+        return sparse_assignment(a, b, threshold)
+    raise ValueError(f"unknown matching method {method}")
+
+
+def partitioned_assignment(
+    a: np.ndarray,
+    b: np.ndarray,
+    parts_a: np.ndarray,
+    parts_b: np.ndarray,
+    threshold: float,
+    method: str = "sparse",
+    pool: Executor = None,
+    parallel_min: int = 200,
+):
+    """Solve each body part separately and merge back into global indices.
+
+    Lesions only match lesions labelled with the same body part (unknown, -1,
+    is a partition of its own). Partitions with at least `parallel_min`
+    lesions are solved on `pool` when one is given.
+    """
+    jobs = []
+    for part in np.intersect1d(parts_a, parts_b):
+        ai = np.flatnonzero(parts_a == part)
+        bi = np.flatnonzero(parts_b == part)
+        jobs.append((ai, bi))
+
+    def submit(ai, bi):
+        if pool is not None and len(ai) + len(bi) >= parallel_min:
+            return pool.submit(solve_assignment, a[ai], b[bi], threshold, method)
+        return solve_assignment(a[ai], b[bi], threshold, method)
+
+    results = [submit(ai, bi) for ai, bi in jobs]
+
+    # start from empty arrays so concatenate works with no shared body part
+    empty_rows, empty_cols, empty_dists = _empty()
+    rows, cols, dists = [empty_rows], [empty_cols], [empty_dists]
+    for (ai, bi), res in zip(jobs, results):
+        r, c, d = res.result() if isinstance(res, Future) else res
+        rows.append(ai[r])
+        cols.append(bi[c])
+        dists.append(d)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(dists)
+
+
+def _normalize(pts: np.ndarray):
+    centered = pts - pts.mean(axis=0)
+    scale = np.sqrt((centered**2).sum(axis=1).mean())
+    return centered / scale if scale > 0 else centered
+
+
+def _within(a: np.ndarray, b: np.ndarray, threshold: float) -> int:
+    # lesions of a with some lesion of b within the threshold
+    d, _ = cKDTree(b).query(a, distance_upper_bound=threshold)
+    return int(np.isfinite(d).sum())
+
+
+def estimate_transform(
+    a: np.ndarray,
+    b: np.ndarray,
+    threshold: float,
+    parts_a: np.ndarray = None,
+    parts_b: np.ndarray = None,
+    model: str = "similarity",
+    k: int = 3,
+    max_trials: int = 200,
+    max_scale_change: float = 2.0,
+    seed: int = 0,
+):
+    """Estimate the camera motion between two visits from the lesions alone.
+
+    Both sets are normalized for position and spread, and each lesion of `a`
+    gets its k nearest lesions of `b` (on the same body part, when labels are
+    given) as candidate pairs. RANSAC then fits a similarity or affine
+    transform to the candidates. Returns the transform mapping `a` onto `b`,
+    or None when it does not bring more lesions within the threshold than
+    leaving the points where they are.
+    """
+    min_samples = 2 if model == "similarity" else 3
+    if len(a) < min_samples + 1 or len(b) < min_samples + 1:
+        return None
+
+    na, nb = _normalize(a), _normalize(b)
+    k = min(k, len(b))
+    _, idx = cKDTree(nb).query(na, k=k)
+    idx = idx.reshape(len(a), k)
+    src = np.repeat(np.arange(len(a)), k)
+    dst = idx.ravel()
+    if parts_a is not None and parts_b is not None:
+        same = parts_a[src] == parts_b[dst]
+        src, dst = src[same], dst[same]
+    if len(src) < min_samples:
+        return None
+
+    model_class = SimilarityTransform if model == "similarity" else AffineTransform
+    transform, inliers = ransac(
+        (a[src], b[dst]),
+        model_class,
+        min_samples=min_samples,
+        residual_threshold=threshold,
+        max_trials=max_trials,
+        rng=seed,
+    )
+    if transform is None or inliers is None or inliers.sum() < min_samples + 1:
+        return None
+
+    # reject degenerate fits, e.g. everything collapsing onto a few lesions
+    scale = np.sqrt(abs(np.linalg.det(transform.params[:2, :2])))
+    if not (1 / max_scale_change <= scale <= max_scale_change):
+        return None
+
+    if _within(transform(a), b, threshold) <= _within(a, b, threshold):
+        return None
+    return transform
@@ -0,0 +1,313 @@
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter as Tally
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional, Tuple
+from flask import Flask, g, request
+from cache import LRUCache
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# seconds; covers both quick api calls and full-resolution inference on cpu
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CALL_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+# ?profile=1 (or an X-Profile: 1 header) samples the request when enabled
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "0") == "1"
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metric:
+    name: str
+    help: str
+    kind: str
+    labelnames: Tuple[str, ...]
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + _labels(self.labelnames, k), v) for k, v in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name} {value}" for name, value in self.samples()]
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # per-bucket counts (not cumulative), sum, count
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in self._values.items()]
+        out = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = f'le="{bound}"'
+                out.append((self.name + "_bucket" + _labels(self.labelnames, key, le), cumulative))
+            out.append((self.name + "_bucket" + _labels(self.labelnames, key, 'le="+Inf"'), count))
+            out.append((self.name + "_sum" + _labels(self.labelnames, key), total))
+            out.append((self.name + "_count" + _labels(self.labelnames, key), count))
+        return out
+
+
+class MetricsRegistry:
+    """Metrics of this process, rendered in the Prometheus text format.
+
+    Collectors are called on every scrape, for values that already live
+    elsewhere (cache counters, queue lengths) and are cheaper to read than
+    to mirror.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collect: Callable[[], list]):
+        """`collect` returns a list of Metric objects, built fresh for the scrape."""
+        self.collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        for collect in self.collectors:
+            try:
+                for metric in collect():
+                    lines += metric.render()
+            except Exception as e:
+                # a broken collector (e.g. broker down) should not hide the rest
+                lines.append(f"# collector {getattr(collect, '__name__', collect)} failed: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+requestSeconds = registry.histogram(
+    "http_request_duration_seconds", "Flask request latency", ("route", "method", "status")
+)
+requestCalls = registry.histogram(
+    "http_request_backend_calls",
+    "DB queries and storage calls made by one request",
+    ("route", "system"),
+    CALL_BUCKETS,
+)
+stageSeconds = registry.histogram(
+    "stage_duration_seconds", "Time spent in each processing stage", ("stage",)
+)
+backendCalls = registry.counter("backend_calls_total", "DB queries and storage calls", ("system", "op"))
+taskSeconds = registry.histogram(
+    "task_duration_seconds", "Background task run time", ("task", "outcome")
+)
+tasksEnqueued = registry.counter("tasks_enqueued_total", "Background tasks submitted", ("task",))
+tasksRunning = registry.gauge("tasks_running", "Background tasks running in this process", ("task",))
+
+
+def stage(name: str):
+    """Time a block as one processing stage, e.g. `with stage("decode"): ...`"""
+    return stageSeconds.time(stage=name)
+
+
+class RequestStats:
+    calls: Tally
+    started: float
+
+    def __init__(self):
+        self.calls = Tally()
+        self.started = time.perf_counter()
+
+
+_request: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def count_call(system: str, op: str):
+    # calls on helper threads are counted globally but not per request
+    backendCalls.inc(system=system, op=op)
+    stats = _request.get()
+    if stats is not None:
+        stats.calls[system] += 1
+
+
+@contextmanager
+def track_task(name: str):
+    tasksRunning.inc(task=name)
+    start = time.perf_counter()
+    outcome = "failure"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        tasksRunning.dec(task=name)
+        taskSeconds.observe(time.perf_counter() - start, task=name, outcome=outcome)
+
+
+class SamplingProfiler:
+    """Samples one thread's stack every `interval` seconds from a helper thread.
+
+    The result is in the folded format flamegraph.pl and speedscope read:
+    one line per distinct stack, root first, followed by its sample count.
+    """
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Tally()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self) -> "SamplingProfiler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+# recent profiles by id, served by /metrics/profile
+profiles = LRUCache(maxsize=int(os.getenv("PROFILE_KEEP", "50")), ttl=3600)
+
+
+def _route() -> str:
+    # the url rule, not the path, so ids do not become label values
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def _begin_request():
+    g.request_stats = RequestStats()
+    g.request_stats_token = _request.set(g.request_stats)
+    wanted = request.args.get("profile") == "1" or request.headers.get("X-Profile") == "1"
+    if PROFILE_REQUESTS and wanted:
+        g.profiler = SamplingProfiler(threading.get_ident()).start()
+
+
+def _end_request(response):
+    stats = g.pop("request_stats", None)
+    if stats is None:
+        return response
+    _request.reset(g.pop("request_stats_token"))
+
+    route = _route()
+    requestSeconds.observe(
+        time.perf_counter() - stats.started,
+        route=route,
+        method=request.method,
+        status=response.status_code,
+    )
+    for system in ("db", "storage"):
+        requestCalls.observe(stats.calls[system], route=route, system=system)
+
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profile_id = uuid.uuid4().hex
+        profiles.set(profile_id, profiler.stop())
+        response.headers["X-Profile-Id"] = profile_id
+    return response
+
+
+def init_app(app: Flask):
+    app.before_request(_begin_request)
+    app.after_request(_end_request)
@@ -0,0 +1,283 @@
+import hashlib
+import logging
+import os
+import pickle
+import platform
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+import torch
+from detectron2.config import get_cfg
+from detectron2.data import transforms as T
+from detectron2.engine import DefaultPredictor
+from detectron2.modeling.postprocessing import detector_postprocess
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+# serve models/*/model.ts (see export.py) instead of eager detectron2 when present
+USE_EXPORTED = os.getenv("USE_EXPORTED_MODELS", "1") == "1"
+
+
+class ModelSpec:
+    name: str
+    config_path: str
+    weights_path: str
+    score_thresh: float
+
+    def __init__(self, name, config_path, weights_path, score_thresh=0.2):
+        self.name = name
+        self.config_path = config_path
+        self.weights_path = weights_path
+        self.score_thresh = score_thresh
+
+    @property
+    def export_path(self) -> str:
+        return os.path.join(os.path.dirname(self.weights_path), "model.ts")
+
+    @property
+    def schema_path(self) -> str:
+        return os.path.join(os.path.dirname(self.weights_path), "model.ts.schema")
+
+    def has_export(self) -> bool:
+        # an export older than the weights it was made from is ignored
+        return (
+            os.path.exists(self.export_path)
+            and os.path.exists(self.schema_path)
+            and os.path.getmtime(self.export_path) >= os.path.getmtime(self.weights_path)
+        )
+
+    def paths(self):
+        # every file the served model is built from
+        paths = [self.config_path, self.weights_path]
+        if USE_EXPORTED and self.has_export():
+            paths.append(self.export_path)
+        return paths
+
+    def mtime(self) -> float:
+        return max(os.path.getmtime(p) for p in self.paths())
+
+
+class LoadedModel:
+    predictor: DefaultPredictor
+    cfg: object
+    mtime: float
+    loaded_at: float
+    load_seconds: float
+    memory_bytes: int
+
+    def __init__(self, predictor, cfg, mtime, loaded_at, load_seconds, memory_bytes):
+        self.predictor = predictor
+        self.cfg = cfg
+        self.mtime = mtime
+        self.loaded_at = loaded_at
+        self.load_seconds = load_seconds
+        self.memory_bytes = memory_bytes
+
+
+class TracedModel:
+    """Runs a model exported by export.py, one image at a time.
+
+    Takes and returns the same list-of-dicts as a detectron2 model in eval
+    mode, so batchPredict works with it unchanged.
+    """
+
+    def __init__(self, module, schema):
+        self.module = module
+        self.schema = schema
+
+    def __call__(self, inputs):
+        outputs = []
+        for inp in inputs:
+            flat = self.module(inp["image"])
+            instances = self.schema(flat)[0]["instances"]
+            outputs.append({"instances": detector_postprocess(instances, inp["height"], inp["width"])})
+        return outputs
+
+    def parameters(self):
+        return self.module.parameters()
+
+    def buffers(self):
+        return self.module.buffers()
+
+
+class TracedPredictor:
+    """Drop-in replacement for DefaultPredictor backed by a TorchScript model."""
+
+    def __init__(self, cfg, module, schema):
+        self.cfg = cfg
+        self.model = TracedModel(module, schema)
+        self.aug = T.ResizeShortestEdge(
+            [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+        )
+        self.input_format = cfg.INPUT.FORMAT
+
+    def __call__(self, original_image):
+        with torch.no_grad():
+            if self.input_format == "RGB":
+                original_image = original_image[:, :, ::-1]
+            height, width = original_image.shape[:2]
+            image = self.aug.get_transform(original_image).apply_image(original_image)
+            image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+            return self.model([{"image": image, "height": height, "width": width}])[0]
+
+
+def spec_cfg(spec: ModelSpec):
+    cfg = get_cfg()
+    cfg.merge_from_file(spec.config_path)
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = spec.score_thresh
+    cfg.MODEL.WEIGHTS = spec.weights_path
+    if platform.system() == "Darwin" or os.getenv("MODEL_DEVICE") == "cpu":
+        cfg.MODEL.DEVICE = "cpu"
+    return cfg
+
+
+def build_predictor(spec: ModelSpec, exported: bool = USE_EXPORTED):
+    cfg = spec_cfg(spec)
+    if exported and spec.has_export():
+        # exported models are traced for cpu
+        cfg.MODEL.DEVICE = "cpu"
+        module = torch.jit.load(spec.export_path, map_location="cpu")
+        with open(spec.schema_path, "rb") as f:
+            schema = pickle.load(f)
+        return TracedPredictor(cfg, module, schema), cfg
+    return DefaultPredictor(cfg), cfg
+
+
+def model_memory(predictor: DefaultPredictor) -> int:
+    # parameters + buffers, i.e. what the weights occupy once loaded on the device
+    model = predictor.model
+    total = 0
+    for t in list(model.parameters()) + list(model.buffers()):
+        total += t.numel() * t.element_size()
+    return total
+
+
+class ModelRegistry:
+    """Process-wide cache of detectron2 predictors.
+
+    Models are built lazily on first use (or eagerly with `preload`) and
+    rebuilt when their config or weights file changes on disk.
+    """
+
+    def __init__(self, specs: Dict[str, ModelSpec], reload_check_interval: float = 5.0):
+        self.specs = specs
+        self.reload_check_interval = reload_check_interval
+        self._models: Dict[str, LoadedModel] = {}
+        self._last_check: Dict[str, float] = {}
+        self._load_locks = {name: threading.Lock() for name in specs}
+        self._use_locks = {name: threading.Lock() for name in specs}
+
+    def _load(self, name: str) -> LoadedModel:
+        spec = self.specs[name]
+        mtime = spec.mtime()
+        start = time.perf_counter()
+        predictor, cfg = build_predictor(spec)
+        elapsed = time.perf_counter() - start
+        loaded = LoadedModel(predictor, cfg, mtime, time.time(), elapsed, model_memory(predictor))
+        logging.getLogger(__name__).info(
+            "loaded model %s in %.2fs (%.1f MiB)", name, elapsed, loaded.memory_bytes / 2**20
+        )
+        return loaded
+
+    def _is_stale(self, name: str, loaded: LoadedModel) -> bool:
+        now = time.monotonic()
+        if now - self._last_check.get(name, 0.0) < self.reload_check_interval:
+            return False
+        self._last_check[name] = now
+        try:
+            return self.specs[name].mtime() != loaded.mtime
+        except OSError:
+            # weights are being replaced, keep serving the old ones
+            return False
+
+    def entry(self, name: str) -> LoadedModel:
+        loaded = self._models.get(name)
+        if loaded is not None and not self._is_stale(name, loaded):
+            return loaded
+
+        with self._load_locks[name]:
+            current = self._models.get(name)
+            if current is not None and current is not loaded:
+                # another thread loaded it while we waited
+                return current
+            self._models[name] = self._load(name)
+            self._last_check[name] = time.monotonic()
+            return self._models[name]
+
+    def get(self, name: str) -> DefaultPredictor:
+        return self.entry(name).predictor
+
+    def cfg(self, name: str):
+        return self.entry(name).cfg
+
+    @contextmanager
+    def use(self, name: str):
+        """Borrow a predictor for one inference call.
+
+        Calls on the same model are serialized; different models can run at
+        the same time.
+        """
+        predictor = self.get(name)
+        with self._use_locks[name]:
+            yield predictor
+
+    def reload(self, name: Optional[str] = None):
+        names = [name] if name is not None else list(self.specs)
+        for n in names:
+            with self._load_locks[n]:
+                self._models[n] = self._load(n)
+                self._last_check[n] = time.monotonic()
+
+    def version(self) -> str:
+        """Fingerprint of every model's config and weights, to tag results with.
+
+        Built from file names, sizes and mtimes rather than contents: this
+        runs on the upload request, and hashing the weights means reading
+        hundreds of MB. Replacing a file changes its mtime, so results from
+        different weights never share a version; the same weights copied to
+        another machine may get a new one, which only costs a cache miss.
+        """
+        digest = hashlib.sha256()
+        for spec in self.specs.values():
+            for path in spec.paths():
+                st = os.stat(path)
+                digest.update(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns};".encode())
+        return digest.hexdigest()[:16]
+
+    def preload(self):
+        for name in self.specs:
+            self.entry(name)
+
+    def stats(self):
+        return {
+            name: {
+                "loaded": name in self._models,
+                "loadSeconds": self._models[name].load_seconds if name in self._models else None,
+                "memoryBytes": self._models[name].memory_bytes if name in self._models else None,
+                "loadedAt": self._models[name].loaded_at if name in self._models else None,
+                "exported": isinstance(self._models[name].predictor, TracedPredictor)
+                if name in self._models
+                else None,
+            }
+            for name in self.specs
+        }
+
+
+def _spec(name: str, directory: str) -> ModelSpec:
+    return ModelSpec(
+        name,
+        os.path.join(MODEL_DIR, directory, "config.yaml"),
+        os.path.join(MODEL_DIR, directory, "model.pth"),
+    )
+
+
+LESION_MODEL = "lesion"
+SEGMENTATION_MODEL = "segmentation"
+
+registry = ModelRegistry(
+    {
+        LESION_MODEL: _spec(LESION_MODEL, "detection_model"),
+        SEGMENTATION_MODEL: _spec(SEGMENTATION_MODEL, "segmentation_model"),
+    },
+    reload_check_interval=float(os.getenv("MODEL_RELOAD_INTERVAL", "5")),
+)
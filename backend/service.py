@@ -1,24 +1,80 @@
-import io
-import platform
+import datetime
+import hashlib
+import json
+import math
+import os
+import tempfile
+from itertools import groupby
 from numpy import asarray, float64
 import numpy as np
 import pandas as pd
-import ot
-import scipy
-from db import getSession, User, Patient, Image
+import torch
+from db import getSession, User, Patient, Image, DetectedLesion
 from werkzeug.datastructures import FileStorage
-import boto3
 import uuid
-from sqlalchemy.orm import Query
-from botocore.client import Config
+from sqlalchemy import and_, delete, func, insert, or_, select, update
+from sqlalchemy.orm import Query, raiseload
 from detectron2 import model_zoo
 from detectron2.engine import DefaultPredictor
-from detectron2.config import get_cfg
+from detectron2.layers import batched_nms
 from detectron2.utils.visualizer import Visualizer
 from detectron2.data import MetadataCatalog, DatasetCatalog
 from PIL import Image as Image2
-from skimage.measure import regionprops, label
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from cache import LRUCache
+from storage import existing_signer, get_storage, get_signer, uploadLatency
+from matching import estimate_transform, partitioned_assignment, solve_assignment
+from registry import registry, LESION_MODEL, SEGMENTATION_MODEL
+import metrics
+
+PARALLEL_INFERENCE = os.getenv("PARALLEL_INFERENCE", "1") == "1"
+inferencePool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("INFERENCE_THREADS", "2")), thread_name_prefix="inference"
+)
+# e.g. 0.9 to accept lesions that are 90% inside a body part; unset keeps the
+# strict all-corners-inside rule
+BODY_PART_MIN_OVERLAP = (
+    float(os.getenv("BODY_PART_MIN_OVERLAP")) if os.getenv("BODY_PART_MIN_OVERLAP") else None
+)
+# parsed lesion sets and match results; the TTL bounds staleness when
+# inference runs in a separate worker process
+lesionCache = LRUCache(
+    maxsize=int(os.getenv("LESION_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("LESION_CACHE_TTL", "600")),
+)
+matchCache = LRUCache(
+    maxsize=int(os.getenv("MATCH_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("LESION_CACHE_TTL", "600")),
+)
+# max distance in pixels between two lesions considered the same lesion
+MATCH_THRESHOLD = float(os.getenv("MATCH_THRESHOLD", "20"))
+# "sparse" (KD-tree candidates, solved per cluster) or "dense" (full matrix)
+MATCH_METHOD = os.getenv("MATCH_METHOD", "sparse")
+# only match lesions on the same body part; big body parts are solved on
+# matchPool in parallel. Off by default: body parts come from strict
+# containment, so a lesion near a limb boundary can be unlabelled (-1) on one
+# visit and labelled on the next, and would then never match
+MATCH_BY_BODY_PART = os.getenv("MATCH_BY_BODY_PART", "0") == "1"
+# align the two lesion sets (RANSAC similarity transform) before matching
+MATCH_REGISTER = os.getenv("MATCH_REGISTER", "1") == "1"
+matchPool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("MATCH_THREADS", "4")), thread_name_prefix="match"
+)
+# detect lesions on overlapping full-resolution tiles, for small lesions on
+# high resolution body photos
+TILED_DETECTION = os.getenv("TILED_DETECTION", "0") == "1"
+TILE_SIZE = int(os.getenv("TILE_SIZE", "800"))  # INPUT.MIN_SIZE_TEST, tiles run at 1:1
+TILE_OVERLAP = int(os.getenv("TILE_OVERLAP", "128"))
+TILE_BATCH = int(os.getenv("TILE_BATCH", "4"))
+TILE_NMS_IOU = float(os.getenv("TILE_NMS_IOU", "0.5"))
+# decode images at the size the models actually use instead of full resolution
+DOWNSCALE_INPUT = os.getenv("DOWNSCALE_INPUT", "1") == "1"
+DOWNLOAD_SPOOL_SIZE = int(os.getenv("DOWNLOAD_SPOOL_SIZE", str(8 * 2**20)))
+# sample every n-th mask pixel when computing mask statistics
+MASK_STRIDE = int(os.getenv("MASK_STRIDE", "1"))
+INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", "4"))
+ioPool = ThreadPoolExecutor(max_workers=int(os.getenv("IO_THREADS", "8")), thread_name_prefix="io")
 
 
 class DetectedObject:
@@ -29,15 +85,12 @@ class DetectedObject:
     class_tag: str
 
     def __init__(self, object_number: int, area, centroid, bounding_box, class_tag):
+        # centroid is (row, col), bounding_box is (min_row, min_col, max_row, max_col)
+        # with exclusive max, same as skimage regionprops
         self.object_number = object_number
         self.area = area
-        self.centroid = (centroid[1], centroid[2])
-        self.bounding_box = (
-            bounding_box[1],
-            bounding_box[2],
-            bounding_box[4],
-            bounding_box[5],
-        )
+        self.centroid = centroid
+        self.bounding_box = bounding_box
         self.class_tag = class_tag
 
     def __str__(self) -> str:
@@ -49,12 +102,33 @@ class JsonLesion:
     x: float
     y: float
     radius: float
+    bodyPart: int
 
-    def __init__(self, id, x, y, radius):
+    def __init__(self, id, x, y, radius, bodyPart=-1):
         self.id = id
         self.x = x
         self.y = y
         self.radius = radius
+        self.bodyPart = bodyPart
+
+
+class MatchResult:
+    pairs: List[dict]
+    unmatchedA: List[int]
+    unmatchedB: List[int]
+
+    def __init__(self, pairs, unmatchedA, unmatchedB):
+        # pairs are {"a": id in A, "b": id in B, "distance": float}, unmatched
+        # lists hold lesion ids
+        self.pairs = pairs
+        self.unmatchedA = unmatchedA
+        self.unmatchedB = unmatchedB
+
+    def asJson(self):
+        return {"mappings": self.pairs, "unmatchedA": self.unmatchedA, "unmatchedB": self.unmatchedB}
+
+    def __str__(self) -> str:
+        return f"MatchResult(pairs: {len(self.pairs)}, unmatchedA: {len(self.unmatchedA)}, unmatchedB: {len(self.unmatchedB)})"
 
 
 class Lesion:
@@ -101,17 +175,30 @@ def createPatient(name: str, owner_id: int):
         return patient
 
 
-def createImage(url: str, patient_id: int):
-    image = Image(imageUrl=url, patient_id=patient_id)
+def createImage(url: str, patient_id: int, contentHash: str = None):
+    image = Image(imageUrl=url, patient_id=patient_id, contentHash=contentHash)
     with getSession() as session:
         session.add(image)
         session.commit()
         return image
 
 
+# relationships load lazily by default; each query below asks for exactly
+# what its caller needs and raises on anything else instead of silently
+# issuing more queries
+
+
 def getUser(id: int):
+    # just the user row, this runs on every authenticated request
     with getSession() as session:
-        return session.get(User, id)
+        return session.get(User, id, options=[raiseload("*")])
+
+
+def getUserPatients(user_id: int):
+    with getSession() as session:
+        return session.execute(
+            select(Patient.id, Patient.name).where(Patient.owner_id == user_id).order_by(Patient.id)
+        ).all()
 
 
 def getUserGoogle(googleId: str):
@@ -121,12 +208,56 @@ def getUserGoogle(googleId: str):
 
 def getPatient(id: int):
     with getSession() as session:
-        return session.get(Patient, id)
+        return session.get(Patient, id, options=[raiseload("*")])
+
+
+def getPatientImages(patient_id: int, limit: int = None, after: str = None):
+    """A page of a patient's images in timestamp order.
+
+    Returns (images, cursor); pass the cursor back as `after` to get the next
+    page. The cursor is None on the last page. Raises ValueError for a limit
+    below 1 or a malformed cursor.
+    """
+    if limit is not None and limit < 1:
+        raise ValueError(f"limit must be at least 1, got {limit}")
+    query = select(Image).where(Image.patient_id == patient_id).options(raiseload("*"))
+    if after is not None:
+        timestamp, id = decodeImageCursor(after)
+        query = query.where(
+            or_(Image.timestamp > timestamp, and_(Image.timestamp == timestamp, Image.id > id))
+        )
+    query = query.order_by(Image.timestamp, Image.id)
+    if limit is not None:
+        query = query.limit(limit)
+
+    with getSession() as session:
+        images = session.scalars(query).all()
+    cursor = None
+    if limit is not None and len(images) == limit:
+        cursor = encodeImageCursor(images[-1])
+    return images, cursor
+
+
+def encodeImageCursor(image: Image) -> str:
+    return f"{image.timestamp.isoformat()}_{image.id}"
+
+
+def decodeImageCursor(cursor: str):
+    try:
+        timestamp, id = cursor.rsplit("_", 1)
+        return datetime.datetime.fromisoformat(timestamp), int(id)
+    except ValueError:
+        raise ValueError(f"invalid cursor {cursor!r}") from None
 
 
 def getImage(id: int):
     with getSession() as session:
-        return session.get(Image, id)
+        return session.get(Image, id, options=[raiseload("*")])
+
+
+def getImages(ids: List[int]):
+    with getSession() as session:
+        return session.query(Image).filter(Image.id.in_(ids)).all()
 
 
 def deleteUser(id: int):
@@ -148,51 +279,283 @@ def deleteImage(id: int):
 
 
 def uploadImage(file: FileStorage):
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket("comp413")
-    name = str(uuid.uuid4())
-    obj = bucket.Object(name)
-    obj.put(Body=file.stream)
-    obj.wait_until_exists()
+    """Store an uploaded photo, returns (key, content hash).
 
-    return name
+    The bytes are hashed while they are spooled; if the same photo was
+    uploaded before, its S3 object is reused and nothing is uploaded.
+    """
+    digest = hashlib.sha256()
+    with tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE) as buf:
+        for chunk in iter(lambda: file.stream.read(2**20), b""):
+            digest.update(chunk)
+            buf.write(chunk)
+        contentHash = digest.hexdigest()
+
+        existing = findImageByHash(contentHash)
+        if existing != None:
+            return existing.imageUrl, contentHash
+
+        name = str(uuid.uuid4())
+        buf.seek(0)
+        with metrics.stage("upload_image"):
+            get_storage().upload(name, buf)
+
+    return name, contentHash
+
+
+def findImageByHash(contentHash: str):
+    with getSession() as session:
+        return session.scalars(
+            select(Image)
+            .where(Image.contentHash == contentHash)
+            .order_by(Image.lesionModelVersion.is_(None), Image.id)
+            .limit(1)
+            .options(raiseload("*"))
+        ).first()
+
+
+def reuseLesions(img: Image) -> bool:
+    """Copy lesions from an earlier upload of the same bytes, if there is one.
+
+    Only results from the current model version are reused. Returns whether
+    lesions were copied, i.e. whether inference can be skipped; the copies are
+    untracked, so the caller enqueues tracking.
+    """
+    if img.contentHash == None:
+        return False
+
+    version = registry.version()
+    with getSession() as session:
+        source = session.scalars(
+            select(Image)
+            .where(
+                Image.contentHash == img.contentHash,
+                Image.lesionModelVersion == version,
+                Image.id != img.id,
+            )
+            .limit(1)
+            .options(raiseload("*"))
+        ).first()
+        if source == None:
+            return False
+
+        rows = session.scalars(
+            select(DetectedLesion).where(DetectedLesion.image_id == source.id)
+        ).all()
+        copies = [
+            {
+                c.key: getattr(r, c.key)
+                for c in DetectedLesion.__mapper__.column_attrs
+                if c.key not in ("id", "image_id", "trackId")
+            }
+            for r in rows
+        ]
+        session.execute(delete(DetectedLesion).where(DetectedLesion.image_id == img.id))
+        if len(copies) > 0:
+            session.execute(insert(DetectedLesion), [{**c, "image_id": img.id} for c in copies])
+        session.execute(update(Image).where(Image.id == img.id).values(lesionModelVersion=version))
+        session.commit()
+
+    invalidateLesions(img.id)
+    resetTracksAfter(img)
+    return True
 
 
 def uploadLesionInfo(key: str, data: str):
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket("comp413")
-    obj = bucket.Object(key)
-    obj.put(Body=data.encode("utf-8"))
-    obj.wait_until_exists()
+    return get_storage().upload(key, data.encode("utf-8"))
 
 
 def getImageUrl(name: str):
-    s3_client = boto3.client(
-        "s3", config=Config(signature_version="s3v4", region_name="us-east-2")
-    )
-    url = s3_client.generate_presigned_url(
-        "get_object", Params={"Bucket": "comp413", "Key": name}, ExpiresIn=3600
-    )
-    return url
+    return get_signer().sign(name)
+
+
+def getImageUrls(names: List[str]):
+    return get_signer().sign_many(names)
 
 
 def createAndUploadImage(file: FileStorage, patient_id: int):
-    key = uploadImage(file)
-    return createImage(key, patient_id)
+    key, contentHash = uploadImage(file)
+    return createImage(key, patient_id, contentHash)
 
 
 def downloadLesionInfo(img: Image):
-    s3 = boto3.client("s3")
-    buf = io.BytesIO()
-    s3.download_fileobj("comp413", img.imageUrl + ".lesions.json", buf)
-    return buf.getvalue().decode("utf-8")
+    return get_storage().get(img.imageUrl + ".lesions.json").decode("utf-8")
+
+
+def getLesionSet(img: Image):
+    # cached until processLesions writes new results; the model version in the
+    # key keeps a worker process's re-run from being served stale until the TTL
+    return lesionCache.get_or_set((img.id, img.lesionModelVersion), lambda: loadLesionSet(img))
+
+
+def loadLesionSet(img: Image):
+    with getSession() as session:
+        rows = session.scalars(
+            select(DetectedLesion)
+            .where(DetectedLesion.image_id == img.id)
+            .order_by(DetectedLesion.lesionId)
+        ).all()
+    if len(rows) == 0:
+        if img.lesionModelVersion is not None:
+            # processed, and no lesions were found
+            return {"lesions": []}
+        # images processed before lesions were stored in the db only have
+        # the json in S3
+        return json.loads(downloadLesionInfo(img))
+
+    return {
+        "lesions": [
+            {"x": r.x, "y": r.y, "radius": r.radius, "bodyPart": r.bodyPart, "id": r.lesionId}
+            for r in rows
+        ]
+    }
+
+
+def saveLesions(image_id: int, lesions: List[Lesion]):
+    # replace whatever an earlier run stored, one bulk insert for the image
+    rows = [
+        {
+            "image_id": image_id,
+            "lesionId": int(lesion.id),
+            "x": float(lesion.centroid[1]),
+            "y": float(lesion.centroid[0]),
+            "radius": float(lesion.get_radius()),
+            "bodyPart": int(lesion.body_part),
+            "area": float(lesion.area),
+            "bboxMinRow": int(lesion.bounding_box[0]),
+            "bboxMinCol": int(lesion.bounding_box[1]),
+            "bboxMaxRow": int(lesion.bounding_box[2]),
+            "bboxMaxCol": int(lesion.bounding_box[3]),
+        }
+        for lesion in lesions
+    ]
+
+    with getSession() as session:
+        session.execute(delete(DetectedLesion).where(DetectedLesion.image_id == image_id))
+        if len(rows) > 0:
+            session.execute(insert(DetectedLesion), rows)
+        session.commit()
+
+
+def jsonLesions(info) -> List[JsonLesion]:
+    return [
+        JsonLesion(x["id"], x["x"], x["y"], x["radius"], x.get("bodyPart", -1))
+        for x in info["lesions"]
+    ]
+
+
+def matchImages(
+    imgA: Image, imgB: Image, threshold: float = MATCH_THRESHOLD, register: bool = MATCH_REGISTER
+):
+    def compute():
+        a, b = jsonLesions(getLesionSet(imgA)), jsonLesions(getLesionSet(imgB))
+        with metrics.stage("match"):
+            return map_and_match(a, b, threshold, register=register)
+
+    key = ((imgA.id, imgA.lesionModelVersion), (imgB.id, imgB.lesionModelVersion), threshold, register)
+    return matchCache.get_or_set(key, compute)
+
+
+def invalidateLesions(image_id: int):
+    lesionCache.delete_where(lambda key: key[0] == image_id)
+    matchCache.delete_where(lambda key: image_id in (key[0][0], key[1][0]))
+
+
+def cacheStats():
+    return {"lesions": lesionCache.stats(), "matches": matchCache.stats()}
 
 
-def downloadImg(img: Image):
-    s3 = boto3.client("s3")
-    buf = io.BytesIO()
-    s3.download_fileobj("comp413", img.imageUrl, buf)
-    return asarray(Image2.open(buf))
+def cacheMetrics():
+    caches = {"lesions": lesionCache, "matches": matchCache}
+    signer = existing_signer()
+    if signer is not None:
+        caches["presign"] = signer.cache
+    hits = metrics.Counter("cache_hits_total", "Cache hits", ("cache",))
+    misses = metrics.Counter("cache_misses_total", "Cache misses", ("cache",))
+    ratio = metrics.Gauge("cache_hit_ratio", "Hits / lookups since start", ("cache",))
+    entries = metrics.Gauge("cache_entries", "Entries currently cached", ("cache",))
+    for name, cache in caches.items():
+        stats = cache.stats()
+        hits.inc(stats["hits"], cache=name)
+        misses.inc(stats["misses"], cache=name)
+        ratio.set(stats["hitRate"], cache=name)
+        entries.set(stats["size"], cache=name)
+    return [hits, misses, ratio, entries]
+
+
+metrics.registry.add_collector(cacheMetrics)
+
+
+def uploadStats():
+    return uploadLatency.stats()
+
+
+def signerStats():
+    return get_signer().stats()
+
+
+def downloadImg(img: Image, downscale: bool = DOWNSCALE_INPUT and not TILED_DETECTION):
+    """Download and decode an image for inference.
+
+    Returns (BGR uint8 array, scale) where scale is decoded size / original
+    size. The object is streamed into a spooled temp file rather than one big
+    in-memory buffer.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE) as buf:
+        with metrics.stage("download"):
+            get_storage().download_fileobj(img.imageUrl, buf)
+        buf.seek(0)
+        with metrics.stage("decode"):
+            return decodeImage(buf, inferenceSize if downscale else None)
+
+
+def inferenceSize(width: int, height: int):
+    # the size DefaultPredictor would resize to, using the larger of the models
+    size = (0, 0)
+    for name in (LESION_MODEL, SEGMENTATION_MODEL):
+        cfg = registry.cfg(name)
+        scale = min(
+            cfg.INPUT.MIN_SIZE_TEST / min(width, height), cfg.INPUT.MAX_SIZE_TEST / max(width, height)
+        )
+        size = max(size, (math.ceil(width * scale), math.ceil(height * scale)))
+    return size
+
+
+def decodeImage(fp, targetSize=None):
+    pil = Image2.open(fp)
+    width, height = pil.size
+
+    if targetSize is not None:
+        target = targetSize(width, height)
+        if target[0] < width:
+            # JPEGs decode straight to 1/2, 1/4 or 1/8 size, never below target
+            pil.draft(None, target)
+            factor = min(pil.size[0] // target[0], pil.size[1] // target[1])
+            if factor >= 2:
+                if pil.mode not in ("RGB", "L"):
+                    # reduce rejects palette, bilevel and 16-bit images
+                    pil = pil.convert("RGB")
+                pil = pil.reduce(factor)
+
+    # normalize palette/RGBA/grayscale once, in the channel order the models use
+    im = np.ascontiguousarray(asarray(pil.convert("RGB"))[:, :, ::-1])
+    return im, im.shape[1] / width
+
+
+def rescaleObjects(objs: List[DetectedObject], scale: float) -> List[DetectedObject]:
+    # back to the coordinates of the original image
+    if scale == 1:
+        return objs
+    return [
+        DetectedObject(
+            o.object_number,
+            o.area / (scale * scale),
+            (o.centroid[0] / scale, o.centroid[1] / scale),
+            tuple(int(round(v / scale)) for v in o.bounding_box),
+            o.class_tag,
+        )
+        for o in objs
+    ]
 
 
 def getLesions(image_id: int):
@@ -200,57 +563,166 @@ def getLesions(image_id: int):
     if img == None:
         return None
 
-    # download image somehow
-    im = downloadImg(img)
-
-    lesionPred = get_lesion_predictor()
-    segmentPred = get_segmentation_predictor()
+    im, scale = downloadImg(img)
 
-    lesions = predictObjs(lesionPred, im)
-    bodyParts = predictObjs(segmentPred, im)
+    lesions, bodyParts = runPredictors(im)
 
-    segmentedLesions = associateLesionToBodyPart(lesions, bodyParts)
+    with metrics.stage("association"):
+        segmentedLesions = associateLesionToBodyPart(
+            rescaleObjects(lesions, scale), rescaleObjects(bodyParts, scale)
+        )
     return segmentedLesions
 
 
+def runModel(name: str, im):
+    with registry.use(name) as pred:
+        if name == LESION_MODEL and TILED_DETECTION:
+            # includes the per-tile mask statistics
+            with metrics.stage("predict_" + name):
+                return predictTiled(pred, im)
+        with metrics.stage("predict_" + name):
+            outputs = pred(im)
+        return objsFromOutputs(outputs)
+
+
+def runPredictors(im, parallel: bool = PARALLEL_INFERENCE):
+    # the two models are independent, so segmentation runs on the pool
+    # while detection runs on the calling thread
+    if not parallel:
+        return runModel(LESION_MODEL, im), runModel(SEGMENTATION_MODEL, im)
+
+    bodyParts = inferencePool.submit(runModel, SEGMENTATION_MODEL, im)
+    lesions = runModel(LESION_MODEL, im)
+    return lesions, bodyParts.result()
+
+
+def getLesionsBatch(image_ids: List[int]):
+    return lesionsForImages(getImages(image_ids))
+
+
+def lesionsForImages(images: List[Image]):
+    if len(images) == 0:
+        return {}
+
+    chunks = [images[i : i + INFERENCE_BATCH_SIZE] for i in range(0, len(images), INFERENCE_BATCH_SIZE)]
+
+    def fetch(chunk):
+        return [ioPool.submit(downloadImg, img) for img in chunk]
+
+    # download the next chunk while the models run on this one, so they
+    # rarely wait on S3 but at most two chunks are decoded at a time
+    results = {}
+    pending = fetch(chunks[0])
+    for i, chunk in enumerate(chunks):
+        decoded = [f.result() for f in pending]
+        pending = fetch(chunks[i + 1]) if i + 1 < len(chunks) else []
+        lesions, bodyParts = runPredictorsBatch([im for im, _ in decoded])
+        for img, (_, scale), l, b in zip(chunk, decoded, lesions, bodyParts):
+            with metrics.stage("association"):
+                results[img.id] = associateLesionToBodyPart(
+                    rescaleObjects(l, scale), rescaleObjects(b, scale)
+                )
+    return results
+
+
+def runModelBatch(name: str, ims):
+    with registry.use(name) as pred:
+        if name == LESION_MODEL and TILED_DETECTION:
+            # tiles are already batched within each image
+            with metrics.stage("predict_batch_" + name):
+                return [predictTiled(pred, im) for im in ims]
+        with metrics.stage("predict_batch_" + name):
+            outputs = batchPredict(pred, ims)
+        return [objsFromOutputs(o) for o in outputs]
+
+
+def runPredictorsBatch(ims, parallel: bool = PARALLEL_INFERENCE):
+    if not parallel:
+        return runModelBatch(LESION_MODEL, ims), runModelBatch(SEGMENTATION_MODEL, ims)
+
+    bodyParts = inferencePool.submit(runModelBatch, SEGMENTATION_MODEL, ims)
+    lesions = runModelBatch(LESION_MODEL, ims)
+    return lesions, bodyParts.result()
+
+
+def batchPredict(pred: DefaultPredictor, ims):
+    # same preprocessing as DefaultPredictor.__call__, but one forward pass
+    # for the whole list
+    inputs = []
+    for im in ims:
+        if pred.input_format == "RGB":
+            im = im[:, :, ::-1]
+        height, width = im.shape[:2]
+        image = pred.aug.get_transform(im).apply_image(im)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        inputs.append({"image": image.to(pred.cfg.MODEL.DEVICE), "height": height, "width": width})
+
+    with torch.no_grad():
+        return pred.model(inputs)
+
+
 def associateLesionToBodyPart(
-    lesions: List[DetectedObject], bodyParts: List[DetectedObject]
+    lesions: List[DetectedObject],
+    bodyParts: List[DetectedObject],
+    min_overlap: float = BODY_PART_MIN_OVERLAP,
 ) -> List[Lesion]:
-    lesion_list = []
-    for lesion in lesions:
-        found = False
-        for bodyPart in bodyParts:
-            if isInside(lesion.centroid, lesion.bounding_box, bodyPart.bounding_box):
-                # this lesion is inside this body part!
-                lesion_list.append(
-                    Lesion(
-                        lesion.object_number,
-                        lesion.area,
-                        lesion.centroid,
-                        lesion.bounding_box,
-                        bodyPart.class_tag,
-                    )
-                )
-                found = True
-                break
-        if not found:
-            lesion_list.append(
-                Lesion(
-                    lesion.object_number,
-                    lesion.area,
-                    lesion.centroid,
-                    lesion.bounding_box,
-                    -1,
-                )
-            )
-    return lesion_list
+    # each lesion goes to the first body part that contains it, or -1
+    if len(lesions) == 0:
+        return []
+
+    found = np.zeros(len(lesions), dtype=bool)
+    first = np.zeros(len(lesions), dtype=int)
+    if len(bodyParts) > 0:
+        inside = containmentMatrix(
+            np.array([l.centroid for l in lesions], dtype=float64),
+            np.array([l.bounding_box for l in lesions], dtype=float64),
+            np.array([b.bounding_box for b in bodyParts], dtype=float64),
+            min_overlap,
+        )
+        found = inside.any(axis=1)
+        first = inside.argmax(axis=1)
+
+    return [
+        Lesion(
+            lesion.object_number,
+            lesion.area,
+            lesion.centroid,
+            lesion.bounding_box,
+            bodyParts[first[i]].class_tag if found[i] else -1,
+        )
+        for i, lesion in enumerate(lesions)
+    ]
+
+
+def containmentMatrix(centers, boxes, containers, min_overlap: float = None):
+    """(N,2) centers and (N,4) boxes against (M,4) containers -> (N,M) bool.
+
+    Without min_overlap this is the same test as isInside: the center and all
+    four corners must be inside. With it, the center must be inside and at
+    least that fraction of the lesion box must overlap the container.
+    """
+    c = containers[None, :, :]
+    cy = centers[:, None, 0]
+    cx = centers[:, None, 1]
+    center_in = (cy >= c[..., 0]) & (cy <= c[..., 2]) & (cx >= c[..., 1]) & (cx <= c[..., 3])
+
+    b = boxes[:, None, :]
+    box_in = (b[..., 0] >= c[..., 0]) & (b[..., 2] <= c[..., 2]) & (b[..., 1] >= c[..., 1]) & (b[..., 3] <= c[..., 3])
+    if min_overlap is None:
+        return center_in & box_in
+
+    inter_h = np.clip(np.minimum(b[..., 2], c[..., 2]) - np.maximum(b[..., 0], c[..., 0]), 0, None)
+    inter_w = np.clip(np.minimum(b[..., 3], c[..., 3]) - np.maximum(b[..., 1], c[..., 1]), 0, None)
+    area = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    # zero-area boxes fall back to plain containment
+    overlap = np.divide(inter_h * inter_w, area, out=box_in.astype(float64), where=area > 0)
+    return center_in & (overlap >= min_overlap)
 
 
 def isInside(center: tuple[float], bbox: tuple[int], container: tuple[int]):
     if not containsPoint(center, container):
         return False
 
-    # TODO: 90% of the lesion is inside
     # check if the corner points are inside
     top_left = (bbox[0], bbox[1])
     top_right = (bbox[2], bbox[1])
@@ -270,93 +742,424 @@ def containsPoint(pt: tuple[float], box: tuple[int]):
 
 
 def predictObjs(pred: DefaultPredictor, im):
-    outputs = pred(im)
+    return objsFromOutputs(pred(im))
+
+
+def objsFromOutputs(outputs):
+    instances = outputs["instances"]
+    class_labels = instances.pred_classes.to("cpu").numpy()
+    with metrics.stage("mask_stats"):
+        areas, centroids, bboxes = maskStats(instances.pred_masks, MASK_STRIDE)
+
+    # one object per predicted instance, so the class always lines up
+    return [
+        DetectedObject(
+            i + 1,  # Object number starts from 1
+            int(areas[i]),
+            (float(centroids[i, 0]), float(centroids[i, 1])),
+            tuple(int(v) for v in bboxes[i]),
+            class_labels[i],
+        )
+        for i in range(len(class_labels))
+        if areas[i] > 0
+    ]
+
+
+def tileOrigins(length: int, tile: int, overlap: int):
+    if length <= tile:
+        return [0]
+    step = tile - overlap
+    origins = list(range(0, length - tile, step))
+    return origins + [length - tile]
+
+
+def predictTiled(
+    pred: DefaultPredictor,
+    im,
+    tile: int = TILE_SIZE,
+    overlap: int = TILE_OVERLAP,
+    batch: int = TILE_BATCH,
+    iou: float = TILE_NMS_IOU,
+) -> List[DetectedObject]:
+    """Detect on overlapping full-resolution tiles instead of a downsized image.
+
+    Tiles run `batch` at a time and only per-instance statistics are kept, so
+    peak memory is bounded by one batch of tiles. Detections touching a tile
+    edge that is inside the image are dropped (the neighbouring tile sees
+    them whole, as long as they are smaller than the overlap) and duplicates
+    from the overlapping regions are removed with NMS.
+    """
+    height, width = im.shape[:2]
+    origins = [(y, x) for y in tileOrigins(height, tile, overlap) for x in tileOrigins(width, tile, overlap)]
+
+    boxes, scores, classes, areas, centroids, bboxes = [], [], [], [], [], []
+    for start in range(0, len(origins), batch):
+        chunk = origins[start : start + batch]
+        tiles = [im[y : y + tile, x : x + tile] for y, x in chunk]
+        for (y, x), t, outputs in zip(chunk, tiles, batchPredict(pred, tiles)):
+            instances = outputs["instances"]
+            with metrics.stage("mask_stats"):
+                a, c, b = maskStats(instances.pred_masks, MASK_STRIDE)
+            th, tw = t.shape[:2]
+            # interior tile edges, in the same (min_row, min_col, max_row, max_col) order
+            interior = np.array([y > 0, x > 0, y + th < height, x + tw < width])
+            touches = np.stack([b[:, 0] <= 0, b[:, 1] <= 0, b[:, 2] >= th, b[:, 3] >= tw], axis=1)
+            keep = (a > 0) & ~(touches & interior).any(axis=1)
+
+            boxes.append(instances.pred_boxes.tensor.cpu()[keep] + torch.tensor([x, y, x, y]))
+            scores.append(instances.scores.cpu()[keep])
+            classes.append(instances.pred_classes.cpu()[keep])
+            areas.append(a[keep])
+            centroids.append(c[keep] + np.array([y, x]))
+            bboxes.append(b[keep] + np.array([y, x, y, x]))
+
+    if len(boxes) == 0 or sum(len(s) for s in scores) == 0:
+        return []
+    boxes, scores, classes = torch.cat(boxes), torch.cat(scores), torch.cat(classes)
+    areas, centroids, bboxes = np.concatenate(areas), np.concatenate(centroids), np.concatenate(bboxes)
+
+    keep = batched_nms(boxes.float(), scores, classes, iou).numpy()
+    keep.sort()
+    return [
+        DetectedObject(
+            n + 1,
+            int(areas[i]),
+            (float(centroids[i, 0]), float(centroids[i, 1])),
+            tuple(int(v) for v in bboxes[i]),
+            classes[i].item(),
+        )
+        for n, i in enumerate(keep)
+    ]
+
+
+def maskStats(masks: torch.Tensor, stride: int = 1, chunk: int = 16):
+    """Area, centroid and bbox of every instance in a (N,H,W) bool mask stack.
+
+    Works on the masks where they live (usually the GPU) and only copies the
+    per-instance results back. A stride > 1 samples every stride-th pixel,
+    which is much cheaper on full resolution masks; results are scaled back
+    to full resolution coordinates.
+    """
+    n = masks.shape[0]
+    if stride > 1:
+        masks = masks[:, ::stride, ::stride]
+    h, w = masks.shape[1:]
+    row_idx = torch.arange(h, device=masks.device, dtype=torch.float64)
+    col_idx = torch.arange(w, device=masks.device, dtype=torch.float64)
+
+    areas = np.zeros(n, dtype=float64)
+    centroids = np.zeros((n, 2), dtype=float64)
+    bboxes = np.zeros((n, 4), dtype=np.int64)
+    for start in range(0, n, chunk):
+        m = masks[start : start + chunk]
+        rows = m.sum(dim=2, dtype=torch.float64)  # (k,H) pixels per row
+        cols = m.sum(dim=1, dtype=torch.float64)  # (k,W) pixels per column
+        area = rows.sum(dim=1)
+        safe = area.clamp(min=1)
+
+        rows_any = (rows > 0).to(torch.uint8)
+        cols_any = (cols > 0).to(torch.uint8)
+        # argmax returns the first maximal index, i.e. the first occupied row/col
+        box = torch.stack(
+            [
+                rows_any.argmax(dim=1),
+                cols_any.argmax(dim=1),
+                h - rows_any.flip(1).argmax(dim=1),
+                w - cols_any.flip(1).argmax(dim=1),
+            ],
+            dim=1,
+        )
 
-    # Convert the predicted mask to a binary mask
-    mask = outputs["instances"].pred_masks.to("cpu").numpy().astype(bool)
-    class_labels = outputs["instances"].pred_classes.to("cpu").numpy()
+        end = start + m.shape[0]
+        areas[start:end] = area.cpu().numpy()
+        centroids[start:end, 0] = ((rows * row_idx).sum(dim=1) / safe).cpu().numpy()
+        centroids[start:end, 1] = ((cols * col_idx).sum(dim=1) / safe).cpu().numpy()
+        bboxes[start:end] = box.cpu().numpy()
 
-    # Use skimage.measure.regionprops to calculate object parameters
-    labeled_mask = label(mask)
-    props = regionprops(labeled_mask)
+    if stride > 1:
+        areas *= stride * stride
+        centroids *= stride
+        bboxes *= stride
+    return areas, centroids, bboxes
 
-    # map each object
-    return [propsToDetectedObj(prop, i, class_labels) for i, prop in enumerate(props)]
 
+def get_lesion_predictor():
+    return registry.get(LESION_MODEL)
 
-def propsToDetectedObj(prop, idx, labels):
-    object_number = idx + 1  # Object number starts from 1
-    area = prop.area
-    centroid = prop.centroid
-    bounding_box = prop.bbox
 
-    # Check if the corresponding class label exists
-    if idx < len(labels):
-        class_name = labels[idx]
+def get_segmentation_predictor():
+    return registry.get(SEGMENTATION_MODEL)
+
+
+def map_and_match(
+    l1: List[JsonLesion],
+    l2: List[JsonLesion],
+    threshold: float = MATCH_THRESHOLD,
+    method: str = MATCH_METHOD,
+    by_body_part: bool = MATCH_BY_BODY_PART,
+    register: bool = MATCH_REGISTER,
+) -> MatchResult:
+    len_a = len(l1)
+    len_b = len(l2)
+    a = np.array([(l.x, l.y) for l in l1], dtype=float64).reshape(-1, 2)
+    b = np.array([(l.x, l.y) for l in l2], dtype=float64).reshape(-1, 2)
+    parts_a = np.array([l.bodyPart for l in l1], dtype=int)
+    parts_b = np.array([l.bodyPart for l in l2], dtype=int)
+
+    if register:
+        # undo camera shift/zoom/rotation between the visits before matching
+        transform = estimate_transform(
+            a, b, threshold, parts_a if by_body_part else None, parts_b if by_body_part else None
+        )
+        if transform is not None:
+            a = transform(a)
+
+    if by_body_part:
+        row_ind, col_ind, distances = partitioned_assignment(
+            a,
+            b,
+            parts_a,
+            parts_b,
+            threshold,
+            method,
+            matchPool,
+        )
     else:
-        # If class label is not available (should not happen), use 'Unknown' as class name
-        class_name = -1
+        row_ind, col_ind, distances = solve_assignment(a, b, threshold, method)
+
+    # one vectorized cut over the assignment instead of per-pair bookkeeping
+    keep = distances <= threshold
+    rows, cols, distances = row_ind[keep], col_ind[keep], distances[keep]
+    matchedA = np.zeros(len_a, dtype=bool)
+    matchedB = np.zeros(len_b, dtype=bool)
+    matchedA[rows] = True
+    matchedB[cols] = True
+
+    pairs = [
+        {"a": l1[row].id, "b": l2[col].id, "distance": distance}
+        for row, col, distance in zip(rows.tolist(), cols.tolist(), distances.tolist())
+    ]
+    return MatchResult(
+        pairs,
+        [l1[i].id for i in np.flatnonzero(~matchedA)],
+        [l2[i].id for i in np.flatnonzero(~matchedB)],
+    )
 
-    return DetectedObject(object_number, area, centroid, bounding_box, class_name)
 
+def rowLesion(row: DetectedLesion) -> JsonLesion:
+    return JsonLesion(row.lesionId, row.x, row.y, row.radius, row.bodyPart)
 
-def get_lesion_predictor():
-    cfg = get_cfg()
-    cfg.merge_from_file("./models/detection_model/config.yaml")
-    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.2
-    cfg.MODEL.WEIGHTS = "./models/detection_model/model.pth"
-    if platform.system() == "Darwin":
-        cfg.MODEL.DEVICE = "cpu"
-    return DefaultPredictor(cfg)
 
+def afterImage(img: Image, inclusive: bool = False):
+    # (timestamp, id) ordering of a patient's timeline
+    later = Image.id >= img.id if inclusive else Image.id > img.id
+    return or_(Image.timestamp > img.timestamp, and_(Image.timestamp == img.timestamp, later))
 
-def get_segmentation_predictor():
-    cfg = get_cfg()
-    cfg.merge_from_file("./models/segmentation_model/config.yaml")
-    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.2
-    cfg.MODEL.WEIGHTS = "./models/segmentation_model/model.pth"
-    if platform.system() == "Darwin":
-        cfg.MODEL.DEVICE = "cpu"
-    return DefaultPredictor(cfg)
-
-def map_and_match(l1: List[JsonLesion], l2: List[JsonLesion]):
-    len_a = len(l1)
-    len_b = len(l2)
-    distance_matrix = ot.dist(
-        np.array([(l.x, l.y) for l in l1]),
-        np.array([(l.x, l.y) for l in l2]),
-        metric="euclidean",
-    )
-    row_ind, col_ind = scipy.optimize.linear_sum_assignment(distance_matrix)
-
-    pairs = []
-
-    for i in range(len(row_ind)):
-        row = row_ind[i]
-        col = col_ind[i]
-        pairs.append({"a": l1[row].id, "b": l2[col].id, "distance": distance_matrix[row, col]})
-    
-    unmatched = set()
-    a_set = set(row_ind)
-    b_set = set(col_ind)
-
-    if len_a >= len_b:
-        for i in range(len_a):
-            if i not in b_set:
-                unmatched.add(i)
-    else:
-        for i in range(len_b):
-            if i not in a_set:
-                unmatched.add(i)
-                
-    # change this as necessary, mark pairs that we don't want to match bc distance is too great
-    threshold = 20
-    for pair in pairs:
-        if pair["distance"] > threshold:
-            unmatched.add(pair["a"])
 
-    pairs = [pair for pair in pairs if pair["a"] not in unmatched]
+def lockPatient(session, patient_id: int):
+    # serializes tracking per patient until the session commits. sqlite has
+    # no FOR UPDATE, but it only allows one writing transaction at a time
+    session.execute(select(Patient.id).where(Patient.id == patient_id).with_for_update())
+
+
+def trackPatient(patient_id: int, threshold: float = MATCH_THRESHOLD):
+    """Give every lesion of the patient a track id, linking frame to frame.
+
+    Only images that still have untracked lesions are linked, each against
+    the tracks of the image before it, so after an upload this is a single
+    match between the two newest images. Returns the number of frames linked.
+    The patient row is locked while track ids are allocated, so concurrent
+    uploads for one patient are linked one after the other.
+    """
+    with getSession() as session:
+        lockPatient(session, patient_id)
+        first = session.scalars(
+            select(Image)
+            .join(DetectedLesion, DetectedLesion.image_id == Image.id)
+            .where(Image.patient_id == patient_id, DetectedLesion.trackId.is_(None))
+            .order_by(Image.timestamp, Image.id)
+            .limit(1)
+            .options(raiseload("*"))
+        ).first()
+        if first is None:
+            session.commit()  # releases the lock
+            return 0
+
+        # continue from the last tracked frame before it
+        previousImage = session.scalars(
+            select(Image)
+            .join(DetectedLesion, DetectedLesion.image_id == Image.id)
+            .where(Image.patient_id == patient_id, ~afterImage(first, inclusive=True))
+            .order_by(Image.timestamp.desc(), Image.id.desc())
+            .limit(1)
+            .options(raiseload("*"))
+        ).first()
+        start = previousImage if previousImage is not None else first
+
+        rows = session.scalars(
+            select(DetectedLesion)
+            .join(Image, DetectedLesion.image_id == Image.id)
+            .where(Image.patient_id == patient_id, afterImage(start, inclusive=True))
+            .order_by(Image.timestamp, Image.id, DetectedLesion.lesionId)
+            .options(raiseload("*"))
+        ).all()
+        nextTrack = (
+            session.scalar(
+                select(func.max(DetectedLesion.trackId))
+                .join(Image, DetectedLesion.image_id == Image.id)
+                .where(Image.patient_id == patient_id)
+            )
+            or 0
+        ) + 1
+
+        linked = 0
+        previous = None
+        for _, frame in groupby(rows, key=lambda r: r.image_id):
+            frame = list(frame)
+            if all(r.trackId is not None for r in frame):
+                previous = frame
+                continue
+
+            tracks = {}
+            if previous is not None:
+                previousTracks = {r.lesionId: r.trackId for r in previous}
+                result = map_and_match(
+                    [rowLesion(r) for r in previous], [rowLesion(r) for r in frame], threshold
+                )
+                tracks = {p["b"]: previousTracks[p["a"]] for p in result.pairs}
+            for r in frame:
+                if r.lesionId in tracks:
+                    r.trackId = tracks[r.lesionId]
+                else:
+                    r.trackId = nextTrack
+                    nextTrack += 1
+            previous = frame
+            linked += 1
+
+        session.commit()
+        return linked
+
+
+def resetTracksAfter(img: Image):
+    # later frames were linked against the old detections of this image
+    with getSession() as session:
+        lockPatient(session, img.patient_id)
+        later = select(Image.id).where(Image.patient_id == img.patient_id, afterImage(img))
+        session.execute(
+            update(DetectedLesion)
+            .where(DetectedLesion.image_id.in_(later))
+            .values(trackId=None)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+
+
+def hasUntrackedLesions(patient_id: int) -> bool:
+    with getSession() as session:
+        return (
+            session.scalar(
+                select(DetectedLesion.id)
+                .join(Image, DetectedLesion.image_id == Image.id)
+                .where(Image.patient_id == patient_id, DetectedLesion.trackId.is_(None))
+                .limit(1)
+            )
+            is not None
+        )
+
+
+def getPatientTracks(patient_id: int):
+    # read only; lesions not linked yet are left out until trackPatient runs
+    with getSession() as session:
+        rows = session.execute(
+            select(DetectedLesion, Image.timestamp)
+            .join(Image, DetectedLesion.image_id == Image.id)
+            .where(Image.patient_id == patient_id, DetectedLesion.trackId.is_not(None))
+            .order_by(DetectedLesion.trackId, Image.timestamp, Image.id)
+        ).all()
+
+    return [
+        {
+            "trackId": trackId,
+            "lesions": [
+                {
+                    "imageId": r.image_id,
+                    "timestamp": timestamp,
+                    "id": r.lesionId,
+                    "x": r.x,
+                    "y": r.y,
+                    "radius": r.radius,
+                    "bodyPart": r.bodyPart,
+                }
+                for r, timestamp in group
+            ],
+        }
+        for trackId, group in groupby(rows, key=lambda row: row[0].trackId)
+    ]
+
+
+def processLesions(image_id: int):
+    img = getImage(image_id)
+    lesions = getLesions(image_id)
+    if lesions == None:
+        return
+
+    with metrics.stage("save_lesions"):
+        saveLesions(image_id, lesions)
+    with metrics.stage("upload"):
+        uploadLesionInfo(img.imageUrl + ".lesions.json", lesionsToJson(lesions))
+    setLesionModelVersion([image_id])
+    invalidateLesions(image_id)
+
+    with metrics.stage("tracking"):
+        resetTracksAfter(img)
+        trackPatient(img.patient_id)
+
+
+def processLesionsBatch(image_ids: List[int]):
+    images = getImages(image_ids)
+    results = lesionsForImages(images)
+    for img in images:
+        with metrics.stage("save_lesions"):
+            saveLesions(img.id, results[img.id])
+
+    def upload(img: Image):
+        with metrics.stage("upload"):
+            uploadLesionInfo(img.imageUrl + ".lesions.json", lesionsToJson(results[img.id]))
+        invalidateLesions(img.id)
+
+    list(ioPool.map(upload, images))
+    setLesionModelVersion([img.id for img in images])
+
+    with metrics.stage("tracking"):
+        for img in images:
+            resetTracksAfter(img)
+        for patient_id in {img.patient_id for img in images}:
+            trackPatient(patient_id)
+    return [img.id for img in images]
+
+
+def setLesionModelVersion(image_ids: List[int]):
+    with getSession() as session:
+        session.execute(
+            update(Image)
+            .where(Image.id.in_(image_ids))
+            .values(lesionModelVersion=registry.version())
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+
+
+def lesionDict(lesion: Lesion):
+    return {
+        "x": float(lesion.centroid[1]),
+        "y": float(lesion.centroid[0]),
+        "radius": float(lesion.get_radius()),
+        "bodyPart": int(lesion.body_part),
+        "id": lesion.id,
+    }
+
 
-    # return unmatched as well?
+def lesionsToJson(lesions: List[Lesion]):
+    jsonData = {"lesions": [lesionDict(lesion) for lesion in lesions]}
 
-    return pairs
+    return json.dumps(jsonData)
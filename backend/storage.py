@@ -0,0 +1,287 @@
+import hashlib
+import os
+import shutil
+import time
+import threading
+import boto3
+from botocore.client import Config
+from collections import deque
+from pathlib import Path
+from typing import List, Optional
+from cache import LRUCache
+from metrics import count_call
+
+BUCKET = os.getenv("S3_BUCKET", "comp413")
+UPLOAD_CHECKSUM = os.getenv("S3_UPLOAD_CHECKSUM", "0") == "1"
+MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", str(16 * 2**20)))
+MULTIPART_CHUNKSIZE = max(int(os.getenv("S3_MULTIPART_CHUNKSIZE", str(8 * 2**20))), 5 * 2**20)
+
+
+class UploadResult:
+    key: str
+    etag: str
+    size: Optional[int]
+    seconds: float
+    checksum: Optional[str]
+
+    def __init__(self, key, etag, size, seconds, checksum):
+        self.key = key
+        self.etag = etag
+        self.size = size
+        self.seconds = seconds
+        self.checksum = checksum
+
+
+class LatencyRecorder:
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, result: UploadResult) -> UploadResult:
+        with self._lock:
+            self.count += 1
+            self._samples.append(result.seconds)
+        return result
+
+    def stats(self):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return {"count": self.count}
+        return {
+            "count": self.count,
+            "p50": samples[len(samples) // 2],
+            "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+            "max": samples[-1],
+        }
+
+
+uploadLatency = LatencyRecorder()
+
+
+def bodySize(body) -> Optional[int]:
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    try:
+        pos = body.tell()
+        body.seek(0, os.SEEK_END)
+        size = body.tell() - pos
+        body.seek(pos)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def countS3Call(model, **kwargs):
+    count_call("storage", model.name)
+
+
+class S3Storage:
+    """Object storage on S3 (or anything speaking the S3 API, e.g. moto).
+
+    One boto3 client is shared by every thread: clients are thread-safe,
+    unlike sessions and resources, and reusing it keeps credentials,
+    endpoint resolution and the HTTP connection pool warm.
+    """
+
+    def __init__(
+        self,
+        bucket: str = BUCKET,
+        region: str = "us-east-2",
+        endpoint_url: Optional[str] = None,
+        max_pool_connections: int = 32,
+    ):
+        self.bucket = bucket
+        session = boto3.session.Session()
+        self.client = session.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            config=Config(
+                signature_version="s3v4",
+                region_name=region,
+                max_pool_connections=max_pool_connections,
+                tcp_keepalive=True,
+                retries={"max_attempts": 3, "mode": "standard"},
+            ),
+        )
+        # every API call, including multipart parts and ranged downloads
+        self.client.meta.events.register("before-call.s3", countS3Call)
+
+    def put(self, key: str, body):
+        return self.client.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    def upload(self, key: str, body, checksum: bool = UPLOAD_CHECKSUM) -> "UploadResult":
+        """Upload bytes or a seekable stream and trust the PUT response.
+
+        S3 is strongly consistent for new objects, so there is no need to poll
+        for existence afterwards. Streams over MULTIPART_THRESHOLD are sent
+        as a multipart upload without buffering the whole file.
+        """
+        start = time.perf_counter()
+        size = bodySize(body)
+        if size is not None and size > MULTIPART_THRESHOLD:
+            etag, digest = self._multipart(key, body), None
+        else:
+            extra = {"ChecksumAlgorithm": "SHA256"} if checksum else {}
+            res = self.client.put_object(Bucket=self.bucket, Key=key, Body=body, **extra)
+            etag, digest = res["ETag"], res.get("ChecksumSHA256")
+        return uploadLatency.record(UploadResult(key, etag, size, time.perf_counter() - start, digest))
+
+    def _multipart(self, key: str, stream) -> str:
+        mpu = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)
+        upload_id = mpu["UploadId"]
+        try:
+            parts = []
+            while True:
+                chunk = stream.read(MULTIPART_CHUNKSIZE)
+                if not chunk:
+                    break
+                part = self.client.upload_part(
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=len(parts) + 1,
+                    Body=chunk,
+                )
+                parts.append({"ETag": part["ETag"], "PartNumber": len(parts) + 1})
+            res = self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+            )
+            return res["ETag"]
+        except Exception:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def get(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def download_fileobj(self, key: str, fileobj):
+        self.client.download_fileobj(self.bucket, key, fileobj)
+
+    def presign(self, key: str, expires: int = 3600) -> str:
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=expires
+        )
+
+
+class LocalStorage:
+    """Filesystem stand-in for S3, for running offline."""
+
+    def __init__(self, root: str, public_url: Optional[str] = None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.public_url = public_url
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"invalid key {key}")
+        return path
+
+    def put(self, key: str, body):
+        count_call("storage", "PutObject")
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            if isinstance(body, (bytes, bytearray)):
+                f.write(body)
+            else:
+                shutil.copyfileobj(body, f)
+        return {}
+
+    def upload(self, key: str, body, checksum: bool = UPLOAD_CHECKSUM) -> "UploadResult":
+        start = time.perf_counter()
+        size = bodySize(body)
+        self.put(key, body)
+        etag = '"' + hashlib.md5(self._path(key).read_bytes()).hexdigest() + '"'
+        return uploadLatency.record(UploadResult(key, etag, size, time.perf_counter() - start, None))
+
+    def get(self, key: str) -> bytes:
+        count_call("storage", "GetObject")
+        return self._path(key).read_bytes()
+
+    def download_fileobj(self, key: str, fileobj):
+        count_call("storage", "GetObject")
+        with open(self._path(key), "rb") as f:
+            shutil.copyfileobj(f, fileobj)
+
+    def presign(self, key: str, expires: int = 3600) -> str:
+        if self.public_url:
+            return f"{self.public_url.rstrip('/')}/{key}"
+        return self._path(key).as_uri()
+
+
+class UrlSigner:
+    """Presigned GET urls, cached until shortly before they expire."""
+
+    def __init__(self, storage, expires: int = 3600, margin: int = 300, maxsize: int = 10000):
+        self.storage = storage
+        self.expires = expires
+        self.cache = LRUCache(maxsize=maxsize, ttl=expires - margin)
+        self.signed = 0
+        self.sign_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _sign(self, key: str) -> str:
+        start = time.perf_counter()
+        url = self.storage.presign(key, self.expires)
+        with self._lock:
+            self.signed += 1
+            self.sign_seconds += time.perf_counter() - start
+        return url
+
+    def sign(self, key: str) -> str:
+        return self.cache.get_or_set(key, lambda: self._sign(key))
+
+    def sign_many(self, keys: List[str]) -> List[str]:
+        return [self.sign(key) for key in keys]
+
+    def stats(self):
+        return {
+            **self.cache.stats(),
+            "signed": self.signed,
+            "avgSignSeconds": self.sign_seconds / self.signed if self.signed else 0.0,
+        }
+
+
+_storage = None
+_signer = None
+_lock = threading.Lock()
+
+
+def get_signer() -> UrlSigner:
+    global _signer
+    if _signer is None:
+        # before taking the lock, get_storage takes it too
+        storage = get_storage()
+        with _lock:
+            if _signer is None:
+                _signer = UrlSigner(storage, int(os.getenv("PRESIGN_EXPIRES", "3600")))
+    return _signer
+
+
+def existing_signer() -> Optional[UrlSigner]:
+    # for stats, which should not create storage clients as a side effect
+    return _signer
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        with _lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+
+def create_storage():
+    if os.getenv("STORAGE_BACKEND", "s3") == "fs":
+        return LocalStorage(
+            os.getenv("STORAGE_ROOT", "./storage"), os.getenv("STORAGE_PUBLIC_URL")
+        )
+    return S3Storage(
+        region=os.getenv("S3_REGION", "us-east-2"),
+        endpoint_url=os.getenv("S3_ENDPOINT_URL"),
+        max_pool_connections=int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32")),
+    )
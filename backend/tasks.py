@@ -0,0 +1,120 @@
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from celery import current_app, shared_task
+from celery.result import AsyncResult
+from metrics import Gauge, registry, tasksEnqueued, track_task
+from service import getImage, processLesions, processLesionsBatch, trackPatient
+
+# with no broker configured (and not eager), tasks run on this bounded pool
+# in the web process instead of blocking the request that queued them
+LOCAL_TASKS = os.getenv("CELERY_BROKER_URL") is None and os.getenv("CELERY_ALWAYS_EAGER") != "1"
+localPool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("INFERENCE_CONCURRENCY", "2")), thread_name_prefix="tasks"
+)
+
+
+@shared_task(
+    bind=True,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    retry_backoff_max=60,
+    max_retries=3,
+)
+def process_lesions(self, image_id: int):
+    with track_task("process_lesions"):
+        processLesions(image_id)
+    return image_id
+
+
+@shared_task(
+    bind=True,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    retry_backoff_max=60,
+    max_retries=3,
+)
+def process_lesions_batch(self, image_ids: list[int]):
+    with track_task("process_lesions_batch"):
+        return processLesionsBatch(image_ids)
+
+
+@shared_task(
+    bind=True,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    retry_backoff_max=60,
+    max_retries=3,
+)
+def track_patient(self, patient_id: int):
+    with track_task("track_patient"):
+        return trackPatient(patient_id)
+
+
+def submit(task, args, task_id: str = None):
+    if not LOCAL_TASKS:
+        return task.apply_async(args=args, task_id=task_id)
+    # apply() runs the task here, retries included, and stores its state in
+    # the result backend, so status polling works the same
+    task_id = task_id or str(uuid.uuid4())
+    localPool.submit(task.apply, args=args, task_id=task_id)
+    return AsyncResult(task_id)
+
+
+def lesionTaskId(image_id: int):
+    # one task id per image so clients can poll by image id
+    return f"lesions-{image_id}"
+
+
+def enqueueLesions(image_id: int):
+    tasksEnqueued.inc(task="process_lesions")
+    return submit(process_lesions, [image_id], lesionTaskId(image_id))
+
+
+def enqueueTracking(patient_id: int):
+    # for lesions that were never linked, e.g. stored before tracking existed
+    tasksEnqueued.inc(task="track_patient")
+    return submit(track_patient, [patient_id], f"tracks-{patient_id}")
+
+
+def lesionTaskStatus(image_id: int) -> str:
+    state = AsyncResult(lesionTaskId(image_id)).state
+    if state == "PENDING":
+        # no task ran for lesions reused from an identical upload (and older
+        # results expire from the backend), but the image has its lesions
+        img = getImage(image_id)
+        if img is not None and img.lesionModelVersion is not None:
+            return "SUCCESS"
+    return state
+
+
+def enqueueLesionsBatch(image_ids: list[int]):
+    tasksEnqueued.inc(task="process_lesions_batch")
+    return submit(process_lesions_batch, [image_ids])
+
+
+def taskStatus(task_id: str) -> str:
+    return AsyncResult(task_id).state
+
+
+def queueDepth() -> int:
+    """Messages waiting in the default queue, not counting ones a worker has reserved."""
+    if current_app.conf.task_always_eager:
+        return 0
+    if LOCAL_TASKS:
+        # tasks submitted to the pool that no thread has picked up yet
+        return localPool._work_queue.qsize()
+    with current_app.connection_for_read() as conn:
+        # fail the scrape quickly instead of retrying while the broker is down
+        conn.ensure_connection(max_retries=1)
+        queue = current_app.conf.task_default_queue
+        return conn.default_channel.queue_declare(queue=queue, passive=True).message_count
+
+
+def queueMetrics():
+    depth = Gauge("task_queue_depth", "Background tasks waiting for a worker", ("queue",))
+    depth.set(queueDepth(), queue=current_app.conf.task_default_queue)
+    return [depth]
+
+
+registry.add_collector(queueMetrics)
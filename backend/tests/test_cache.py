@@ -0,0 +1,64 @@
+import cache
+from cache import LRUCache
+
+
+def test_get_set_and_stats():
+    c = LRUCache(maxsize=2)
+    assert c.get("a") is None
+    c.set("a", 1)
+    assert c.get("a") == 1
+    assert c.stats() == {"size": 1, "maxsize": 2, "hits": 1, "misses": 1, "hitRate": 0.5}
+
+
+def test_evicts_least_recently_used():
+    c = LRUCache(maxsize=2)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")  # b is now the oldest
+    c.set("c", 3)
+    assert c.get("b") is None
+    assert c.get("a") == 1
+    assert c.get("c") == 3
+
+
+def test_ttl_expires(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    c = LRUCache(ttl=10)
+    c.set("a", 1)
+    c.set("b", 2, ttl=60)
+    now[0] += 11
+    assert c.get("a") is None
+    assert c.get("b") == 2
+
+
+def test_get_or_set_computes_once():
+    c = LRUCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return "value"
+
+    assert c.get_or_set("k", compute) == "value"
+    assert c.get_or_set("k", compute) == "value"
+    assert len(calls) == 1
+
+
+def test_get_or_set_caches_none():
+    c = LRUCache()
+    calls = []
+    c.get_or_set("k", lambda: calls.append(1))
+    c.get_or_set("k", lambda: calls.append(1))
+    assert len(calls) == 1
+
+
+def test_delete_where():
+    c = LRUCache()
+    c.set((1, 2), "a")
+    c.set((2, 3), "b")
+    c.set((3, 4), "c")
+    c.delete_where(lambda key: 2 in key)
+    assert c.get((1, 2)) is None
+    assert c.get((2, 3)) is None
+    assert c.get((3, 4)) == "c"
@@ -0,0 +1,61 @@
+from sqlalchemy import text
+from db import User, getSession
+
+
+def test_sessions_outside_app_context_are_separate():
+    with getSession() as a, getSession() as b:
+        assert a is not b
+
+
+def test_session_shared_within_app_context(app):
+    with app.app_context():
+        with getSession() as a:
+            pass
+        with getSession() as b:
+            assert a is b
+
+
+def test_session_closed_on_teardown(app):
+    with app.app_context():
+        with getSession() as s:
+            s.execute(text("select 1"))
+            assert s.in_transaction()
+    assert not s.in_transaction()
+
+    with app.app_context():
+        with getSession() as other:
+            assert other is not s
+
+
+def test_error_rolls_back_shared_session(app):
+    with app.app_context():
+        try:
+            with getSession() as s:
+                s.add(User(name="a", role="doctor", googleId="g"))
+                s.flush()
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        with getSession() as s:
+            assert s.query(User).count() == 0
+
+
+def test_migrate_pads_sqlite_timestamps(database):
+    from db import Image, Patient, migrate
+
+    with getSession() as s:
+        user = User(name="a", role="doctor", googleId="g")
+        s.add(user)
+        s.flush()
+        patient = Patient(name="p", owner_id=user.id)
+        s.add(patient)
+        s.flush()
+        s.execute(
+            text("INSERT INTO image (patient_id, imageUrl, timestamp) VALUES (:p, 'k', '2024-01-01 10:00:00')"),
+            {"p": patient.id},
+        )
+        s.commit()
+
+    migrate()
+    with getSession() as s:
+        assert s.execute(text("SELECT timestamp FROM image")).scalar() == "2024-01-01 10:00:00.000000"
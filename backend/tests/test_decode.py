@@ -0,0 +1,61 @@
+import io
+import numpy as np
+import pytest
+from PIL import Image as Image2
+from service import decodeImage
+
+WIDTH, HEIGHT = 1200, 1600
+COLOR = (200, 100, 50)  # RGB
+
+
+def encode(mode, fmt):
+    if mode == "I;16":
+        pil = Image2.fromarray(np.full((HEIGHT, WIDTH), 40000, dtype=np.uint16))
+    else:
+        pil = Image2.new("RGB", (WIDTH, HEIGHT), COLOR).convert(mode)
+    buf = io.BytesIO()
+    pil.save(buf, format=fmt)
+    buf.seek(0)
+    return buf
+
+
+def quarter(width, height):
+    return width // 4, height // 4
+
+
+CASES = [
+    ("JPEG", "RGB"),
+    ("JPEG", "L"),
+    ("PNG", "RGB"),
+    ("PNG", "RGBA"),
+    ("PNG", "P"),
+    ("PNG", "L"),
+    ("PNG", "1"),
+    ("PNG", "I;16"),
+]
+
+
+@pytest.mark.parametrize("fmt, mode", CASES)
+@pytest.mark.parametrize("targetSize, expected", [(None, 1.0), (quarter, 0.25)])
+def test_decode_image(fmt, mode, targetSize, expected):
+    im, scale = decodeImage(encode(mode, fmt), targetSize)
+
+    assert scale == expected
+    assert im.shape == (round(HEIGHT * scale), round(WIDTH * scale), 3)
+    assert im.dtype == np.uint8
+    assert im.flags["C_CONTIGUOUS"]
+    b, g, r = im[HEIGHT // 8, WIDTH // 8].astype(int)
+    if mode in ("RGB", "RGBA", "P"):
+        # BGR, like the models expect
+        assert abs(r - COLOR[0]) <= 10 and abs(g - COLOR[1]) <= 10 and abs(b - COLOR[2]) <= 10
+    else:
+        assert b == g == r
+
+
+def test_decode_image_never_below_target():
+    def target(width, height):
+        return 500, 667  # factor 2.4, decodes at 1/2
+
+    im, scale = decodeImage(encode("RGB", "JPEG"), target)
+    assert im.shape[1] >= 500 and im.shape[0] >= 667
+    assert scale == im.shape[1] / WIDTH
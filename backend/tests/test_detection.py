@@ -0,0 +1,180 @@
+import numpy as np
+from types import SimpleNamespace
+import pytest
+import torch
+from skimage.measure import label, regionprops
+from service import (
+    DetectedObject,
+    associateLesionToBodyPart,
+    containmentMatrix,
+    isInside,
+    maskStats,
+    predictTiled,
+)
+
+
+def blobs(rng, n, h=120, w=160):
+    # random ellipses, some cut off by the image border
+    rows, cols = np.mgrid[:h, :w]
+    masks = np.zeros((n, h, w), dtype=bool)
+    for i in range(n):
+        cy, cx = rng.uniform(-10, h + 10), rng.uniform(-10, w + 10)
+        ry, rx = rng.uniform(2, 30, size=2)
+        masks[i] = ((rows - cy) / ry) ** 2 + ((cols - cx) / rx) ** 2 <= 1
+    return masks
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_mask_stats_match_regionprops(seed):
+    masks = blobs(np.random.default_rng(seed), 40)
+    # chunk smaller than n so the chunked path is covered
+    areas, centroids, bboxes = maskStats(torch.from_numpy(masks), chunk=16)
+
+    for i, mask in enumerate(masks):
+        if not mask.any():
+            assert areas[i] == 0
+            continue
+        (props,) = regionprops(mask.astype(np.uint8))
+        assert areas[i] == props.area
+        assert np.allclose(centroids[i], props.centroid)
+        assert tuple(bboxes[i]) == props.bbox
+
+
+def test_mask_stats_stride_approximates_full_resolution():
+    masks = blobs(np.random.default_rng(0), 20)
+    masks = masks[masks.sum(axis=(1, 2)) > 400]
+    full = maskStats(torch.from_numpy(masks))
+    strided = maskStats(torch.from_numpy(masks), stride=2)
+
+    assert np.allclose(strided[0], full[0], rtol=0.1)
+    assert np.abs(strided[1] - full[1]).max() <= 2
+    assert np.abs(strided[2] - full[2]).max() <= 2
+
+
+def boxes(rng, n, size):
+    # integer corners so lesions often sit exactly on container edges
+    tl = rng.integers(0, 200, size=(n, 2))
+    return np.concatenate([tl, tl + rng.integers(1, size, size=(n, 2))], axis=1)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_containment_matrix_matches_is_inside(seed):
+    rng = np.random.default_rng(seed)
+    lesions = boxes(rng, 50, 20)
+    centers = (lesions[:, :2] + lesions[:, 2:]) / 2
+    containers = boxes(rng, 8, 150)
+
+    inside = containmentMatrix(centers.astype(float), lesions.astype(float), containers.astype(float))
+    expected = [[isInside(c, b, k) for k in containers] for c, b in zip(centers, lesions)]
+    assert inside.tolist() == expected
+
+
+def test_containment_matrix_min_overlap():
+    containers = np.array([[0, 0, 100, 100]], dtype=float)
+    # 10x10 lesion boxes: fully inside, 70% inside, center outside
+    lesions = np.array([[10, 10, 20, 20], [10, 93, 20, 103], [10, 96, 20, 106]], dtype=float)
+    centers = (lesions[:, :2] + lesions[:, 2:]) / 2
+
+    assert containmentMatrix(centers, lesions, containers)[:, 0].tolist() == [True, False, False]
+    assert containmentMatrix(centers, lesions, containers, 0.6)[:, 0].tolist() == [True, True, False]
+    assert containmentMatrix(centers, lesions, containers, 0.8)[:, 0].tolist() == [True, False, False]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_associate_lesion_to_first_containing_body_part(seed):
+    rng = np.random.default_rng(seed)
+    lesions = [
+        DetectedObject(i + 1, 1.0, tuple((b[:2] + b[2:]) / 2), tuple(b), 0)
+        for i, b in enumerate(boxes(rng, 50, 20))
+    ]
+    parts = [DetectedObject(i + 1, 1.0, (0, 0), tuple(b), 10 + i) for i, b in enumerate(boxes(rng, 8, 150))]
+
+    result = associateLesionToBodyPart(lesions, parts, None)
+    for lesion, out in zip(lesions, result):
+        box = lesion.bounding_box
+        containing = [p.class_tag for p in parts if isInside(lesion.centroid, box, p.bounding_box)]
+        assert out.body_part == (containing[0] if containing else -1)
+    assert associateLesionToBodyPart(lesions, [], None)[0].body_part == -1
+    assert associateLesionToBodyPart([], parts, None) == []
+
+
+class BlobModel:
+    """Stands in for a detectron2 model: every connected blob in a tile is one instance."""
+
+    def __init__(self):
+        self.tiles = 0
+
+    def __call__(self, inputs):
+        outputs = []
+        for item in inputs:
+            self.tiles += 1
+            labels = label(item["image"][0].numpy() > 0)
+            props = regionprops(labels)
+            masks = np.zeros((len(props),) + labels.shape, dtype=bool)
+            for i, p in enumerate(props):
+                masks[i] = labels == p.label
+            # boxes are (x0, y0, x1, y1)
+            boxes = [[p.bbox[1], p.bbox[0], p.bbox[3], p.bbox[2]] for p in props]
+            instances = SimpleNamespace(
+                pred_masks=torch.from_numpy(masks),
+                pred_boxes=SimpleNamespace(tensor=torch.tensor(boxes, dtype=torch.float32).reshape(-1, 4)),
+                scores=torch.full((len(props),), 0.9),
+                pred_classes=torch.zeros(len(props), dtype=torch.int64),
+            )
+            outputs.append({"instances": instances})
+        return outputs
+
+
+def blobPredictor():
+    identity = SimpleNamespace(apply_image=lambda im: im)
+    return SimpleNamespace(
+        input_format="BGR",
+        aug=SimpleNamespace(get_transform=lambda im: identity),
+        cfg=SimpleNamespace(MODEL=SimpleNamespace(DEVICE="cpu")),
+        model=BlobModel(),
+    )
+
+
+def discs(rng, h, w, centers):
+    # separate discs smaller than the tile overlap
+    rows, cols = np.mgrid[:h, :w]
+    im = np.zeros((h, w, 3), dtype=np.uint8)
+    for cy, cx in centers:
+        r = rng.uniform(4, 20)
+        im[(rows - cy) ** 2 + (cols - cx) ** 2 <= r * r] = 255
+    return im
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_predict_tiled_merges_seams(seed):
+    rng = np.random.default_rng(seed)
+    h, w, tile, overlap = 1000, 1300, 400, 100
+    # tiles start at 0, 300, 600 (and 900 across); put discs on every seam
+    # and in the overlaps, plus a grid of random ones
+    centers = [(395, 150), (305, 500), (350, 350), (650, 690), (150, 905), (960, 1195)]
+    centers += [(y, x) for y in range(60, h, 110) for x in range(60, w, 110) if rng.random() < 0.5]
+    centers = [
+        c for i, c in enumerate(centers) if all(np.hypot(c[0] - o[0], c[1] - o[1]) > 45 for o in centers[:i])
+    ]
+    im = discs(rng, h, w, centers)
+
+    pred = blobPredictor()
+    objs = predictTiled(pred, im, tile=tile, overlap=overlap, batch=3)
+    assert pred.model.tiles == 12
+
+    expected = sorted((int(p.area), p.bbox) for p in regionprops(label(im[..., 0] > 0)))
+    assert sorted((o.area, o.bounding_box) for o in objs) == expected
+    assert [o.object_number for o in objs] == list(range(1, len(objs) + 1))
+    for o in objs:
+        cy, cx = o.centroid
+        (props,) = [p for p in regionprops(label(im[..., 0] > 0)) if p.bbox == o.bounding_box]
+        assert np.allclose((cy, cx), props.centroid)
+
+
+def test_predict_tiled_small_image_is_one_tile():
+    pred = blobPredictor()
+    im = discs(np.random.default_rng(0), 300, 200, [(100, 100)])
+    (obj,) = predictTiled(pred, im, tile=400, overlap=100)
+    assert pred.model.tiles == 1
+    assert obj.bounding_box == regionprops(label(im[..., 0] > 0))[0].bbox
+    assert predictTiled(blobPredictor(), np.zeros_like(im), tile=400, overlap=100) == []
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from matching import dense_assignment, solve_assignment, sparse_assignment
+
+
+def pairs(rows, cols):
+    return set(zip(rows.tolist(), cols.tolist()))
+
+
+def denseCut(a, b, threshold):
+    rows, cols, dists = dense_assignment(a, b)
+    keep = dists <= threshold
+    return pairs(rows[keep], cols[keep])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_sparse_agrees_with_dense_on_separated_lesions(seed):
+    rng = np.random.default_rng(seed)
+    a = rng.uniform(0, 4000, size=(200, 2))
+    b = a + rng.normal(0, 3, size=a.shape)
+    rows, cols, _ = sparse_assignment(a, b, 20.0)
+    assert pairs(rows, cols) == denseCut(a, b, 20.0)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_sparse_on_crowded_lesions(seed):
+    # where the two differ, sparse stays within the threshold and keeps at
+    # least as many pairs as dense followed by the cut
+    rng = np.random.default_rng(seed)
+    a = rng.uniform(0, 150, size=(60, 2))
+    b = np.concatenate([a[:50] + rng.normal(0, 5, size=(50, 2)), rng.uniform(0, 150, size=(10, 2))])
+    rows, cols, dists = sparse_assignment(a, b, 20.0)
+    assert (dists <= 20.0).all()
+    assert len(set(rows.tolist())) == len(rows) and len(set(cols.tolist())) == len(cols)
+    assert len(rows) >= len(denseCut(a, b, 20.0))
+
+
+def test_sparse_keeps_zero_distance_pairs():
+    a = np.array([[0.0, 0.0], [100.0, 100.0]])
+    rows, cols, dists = sparse_assignment(a, a.copy(), 5.0)
+    assert pairs(rows, cols) == {(0, 0), (1, 1)}
+    assert (dists == 0).all()
+
+
+def test_solve_assignment_rejects_unknown_method():
+    with pytest.raises(ValueError):
+        solve_assignment(np.zeros((1, 2)), np.zeros((1, 2)), 1.0, "greedy")
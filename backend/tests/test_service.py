@@ -0,0 +1,294 @@
+import json
+import pytest
+from sqlalchemy import select, update
+from db import DetectedLesion, Image, getSession
+from service import (
+    JsonLesion,
+    Lesion,
+    MatchResult,
+    createImage,
+    findImageByHash,
+    getImage,
+    getLesionSet,
+    getPatientImages,
+    getPatientTracks,
+    hasUntrackedLesions,
+    invalidateLesions,
+    lesionCache,
+    loadLesionSet,
+    map_and_match,
+    matchImages,
+    matchCache,
+    resetTracksAfter,
+    reuseLesions,
+    saveLesions,
+    trackPatient,
+    uploadLesionInfo,
+)
+
+
+@pytest.fixture(autouse=True)
+def caches():
+    # ids restart with every fresh database
+    yield
+    lesionCache.clear()
+    matchCache.clear()
+
+
+def lesion(id, x, y, body_part=0, size=10):
+    # centroid is (row, col) = (y, x)
+    half = size // 2
+    return Lesion(id, size * size, (y, x), (y - half, x - half, y + half, x + half), body_part)
+
+
+def images(patient, n):
+    return [createImage(f"key-{i}", patient.id) for i in range(n)]
+
+
+def setVersion(img):
+    with getSession() as session:
+        session.execute(update(Image).where(Image.id == img.id).values(lesionModelVersion="v"))
+        session.commit()
+    return getImage(img.id)
+
+
+def test_patient_images_pages(patient):
+    ids = [img.id for img in images(patient, 5)]
+
+    seen, after, pages = [], None, 0
+    while True:
+        page, after = getPatientImages(patient.id, 2, after)
+        seen += [img.id for img in page]
+        pages += 1
+        if after is None:
+            break
+    assert seen == ids
+    assert pages == 3
+
+    everything, cursor = getPatientImages(patient.id)
+    assert [img.id for img in everything] == ids
+    assert cursor is None
+
+
+def test_patient_images_exact_multiple_ends_with_empty_page(patient):
+    images(patient, 4)
+    page, after = getPatientImages(patient.id, 2)
+    page, after = getPatientImages(patient.id, 2, after)
+    assert after is not None
+    page, after = getPatientImages(patient.id, 2, after)
+    assert page == [] and after is None
+
+
+def test_patient_images_pages_default_timestamps(patient):
+    # no overrides: several images share a second, so paging relies on the
+    # stored and bound timestamps comparing equal
+    ids = [createImage(f"key-{i}", patient.id).id for i in range(5)]
+
+    seen, after = [], None
+    while True:
+        page, after = getPatientImages(patient.id, 2, after)
+        seen += [img.id for img in page]
+        if after is None:
+            break
+    assert seen == ids
+
+
+@pytest.mark.parametrize(
+    "limit, after", [(0, None), (-1, None), (2, "garbage"), (2, "2024-01-01T00:00:00_x")]
+)
+def test_patient_images_rejects_bad_arguments(patient, limit, after):
+    with pytest.raises(ValueError):
+        getPatientImages(patient.id, limit, after)
+
+
+def test_save_and_load_lesions(patient):
+    (img,) = images(patient, 1)
+    saveLesions(img.id, [lesion(1, 100, 50, 2), lesion(2, 300, 400, -1)])
+    saveLesions(img.id, [lesion(1, 110, 60, 3)])  # replaces the first run
+
+    assert loadLesionSet(img) == {
+        "lesions": [{"x": 110.0, "y": 60.0, "radius": pytest.approx(50**0.5), "bodyPart": 3, "id": 1}]
+    }
+
+
+def test_load_lesion_free_image_without_storage(patient):
+    (img,) = images(patient, 1)
+    img = setVersion(img)
+    saveLesions(img.id, [])
+    # nothing was uploaded, so an S3 fallback would raise
+    assert loadLesionSet(img) == {"lesions": []}
+
+
+def test_load_legacy_image_from_storage(patient):
+    (img,) = images(patient, 1)
+    data = {"lesions": [{"x": 1.0, "y": 2.0, "radius": 3.0, "id": 1}]}
+    uploadLesionInfo(img.imageUrl + ".lesions.json", json.dumps(data))
+    assert loadLesionSet(img) == data
+
+
+def test_map_and_match():
+    l1 = [JsonLesion(1, 100, 100, 5), JsonLesion(2, 200, 200, 5), JsonLesion(3, 900, 900, 5)]
+    l2 = [JsonLesion(10, 203, 198, 5), JsonLesion(11, 98, 101, 5), JsonLesion(12, 500, 500, 5)]
+
+    res = map_and_match(l1, l2, threshold=20, register=False, by_body_part=False)
+    assert isinstance(res, MatchResult)
+    assert sorted((p["a"], p["b"]) for p in res.pairs) == [(1, 11), (2, 10)]
+    assert all(p["distance"] <= 20 for p in res.pairs)
+    assert res.unmatchedA == [3]
+    assert res.unmatchedB == [12]
+    assert set(res.asJson()) == {"mappings", "unmatchedA", "unmatchedB"}
+
+
+@pytest.mark.parametrize("method", ["sparse", "dense"])
+def test_map_and_match_methods_agree_on_separated_lesions(method):
+    l1 = [JsonLesion(i, 100 * i, 50 * i, 5) for i in range(1, 20)]
+    l2 = [JsonLesion(i, 100 * i + 3, 50 * i - 2, 5) for i in range(1, 20)]
+    res = map_and_match(l1, l2, threshold=20, method=method, register=False, by_body_part=False)
+    assert sorted((p["a"], p["b"]) for p in res.pairs) == [(i, i) for i in range(1, 20)]
+
+
+def test_map_and_match_by_body_part():
+    l1 = [JsonLesion(1, 100, 100, 5, bodyPart=0)]
+    l2 = [JsonLesion(1, 101, 100, 5, bodyPart=1)]
+    assert map_and_match(l1, l2, 20, register=False, by_body_part=True).pairs == []
+    assert len(map_and_match(l1, l2, 20, register=False, by_body_part=False).pairs) == 1
+
+
+def test_map_and_match_empty():
+    res = map_and_match([], [JsonLesion(1, 0, 0, 5)], register=False)
+    assert res.pairs == [] and res.unmatchedA == [] and res.unmatchedB == [1]
+
+
+def test_track_patient(patient):
+    first, second, third = images(patient, 3)
+    saveLesions(first.id, [lesion(1, 100, 100), lesion(2, 500, 500)])
+    saveLesions(second.id, [lesion(1, 502, 498), lesion(2, 101, 99)])
+    saveLesions(third.id, [lesion(1, 99, 102), lesion(2, 900, 900)])
+
+    assert hasUntrackedLesions(patient.id)
+    assert trackPatient(patient.id) == 3
+    assert trackPatient(patient.id) == 0
+    assert not hasUntrackedLesions(patient.id)
+
+    def tracks():
+        return sorted(
+            sorted((l["imageId"], l["id"]) for l in t["lesions"]) for t in getPatientTracks(patient.id)
+        )
+
+    expected = sorted(
+        [
+            [(first.id, 1), (second.id, 2), (third.id, 1)],
+            [(first.id, 2), (second.id, 1)],
+            [(third.id, 2)],
+        ]
+    )
+    assert tracks() == expected
+    ids = [t["trackId"] for t in getPatientTracks(patient.id)]
+    assert len(ids) == len(set(ids)) == 3
+
+    # re-detecting the middle image relinks only what comes after it
+    resetTracksAfter(second)
+    assert hasUntrackedLesions(patient.id)
+    assert trackPatient(patient.id) == 1
+    assert tracks() == expected
+
+
+def test_patient_tracks_do_not_link(patient):
+    (img,) = images(patient, 1)
+    saveLesions(img.id, [lesion(1, 100, 100)])
+    assert getPatientTracks(patient.id) == []
+    assert hasUntrackedLesions(patient.id)
+
+
+def test_track_patient_with_default_timestamps(patient):
+    # created within the same second, stamped by the column default
+    first = createImage("key-a", patient.id)
+    second = createImage("key-b", patient.id)
+    saveLesions(first.id, [lesion(1, 100, 100)])
+    saveLesions(second.id, [lesion(1, 101, 99)])
+
+    assert trackPatient(patient.id) == 2
+    assert not hasUntrackedLesions(patient.id)
+    (track,) = getPatientTracks(patient.id)
+    assert sorted(l["imageId"] for l in track["lesions"]) == [first.id, second.id]
+
+
+def setModelVersion(img, version):
+    with getSession() as session:
+        session.execute(update(Image).where(Image.id == img.id).values(lesionModelVersion=version))
+        session.commit()
+
+
+def test_find_image_by_hash_prefers_processed(patient):
+    first = createImage("key-a", patient.id, "hash")
+    second = createImage("key-b", patient.id, "hash")
+    assert findImageByHash("hash").id == first.id
+
+    setModelVersion(second, "v1")
+    assert findImageByHash("hash").id == second.id
+    assert findImageByHash("other") is None
+
+
+def test_reuse_lesions_only_from_current_version(patient, monkeypatch):
+    monkeypatch.setattr("service.registry.version", lambda: "v2")
+    source = createImage("key", patient.id, "hash")
+    saveLesions(source.id, [lesion(1, 100, 100), lesion(2, 500, 500)])
+    setModelVersion(source, "v1")
+    upload = createImage("key", patient.id, "hash")
+
+    assert not reuseLesions(upload)
+    assert not reuseLesions(createImage("key", patient.id, None))
+    setModelVersion(source, "v2")
+    assert reuseLesions(upload)
+    assert getImage(upload.id).lesionModelVersion == "v2"
+
+
+def test_reuse_lesions_copies_rows_untracked(patient, monkeypatch):
+    monkeypatch.setattr("service.registry.version", lambda: "v1")
+    source = createImage("key", patient.id, "hash")
+    saveLesions(source.id, [lesion(1, 100, 100), lesion(2, 500, 500)])
+    setModelVersion(source, "v1")
+    assert trackPatient(patient.id) == 1
+
+    upload = createImage("key", patient.id, "hash")
+    assert reuseLesions(upload)
+
+    def rows(image_id):
+        with getSession() as session:
+            return session.scalars(
+                select(DetectedLesion)
+                .where(DetectedLesion.image_id == image_id)
+                .order_by(DetectedLesion.lesionId)
+            ).all()
+
+    copied, original = rows(upload.id), rows(source.id)
+    assert len(copied) == len(original) == 2
+    fields = ("lesionId", "x", "y", "radius", "bodyPart", "area", "bboxMinRow", "bboxMaxCol")
+    for c, o in zip(copied, original):
+        assert [getattr(c, f) for f in fields] == [getattr(o, f) for f in fields]
+        assert c.id != o.id and c.trackId is None and o.trackId is not None
+    # tracking is left to the caller
+    assert hasUntrackedLesions(patient.id)
+    assert loadLesionSet(getImage(upload.id))["lesions"] == loadLesionSet(getImage(source.id))["lesions"]
+
+
+def test_caches_key_on_model_version(patient):
+    # a worker process re-runs detection: new rows and version, no invalidation here
+    first, second = images(patient, 2)
+    saveLesions(first.id, [lesion(1, 100, 100)])
+    saveLesions(second.id, [lesion(1, 101, 99)])
+    setModelVersion(first, "v1")
+    setModelVersion(second, "v1")
+    first, second = getImage(first.id), getImage(second.id)
+    assert len(getLesionSet(first)["lesions"]) == 1
+    assert len(matchImages(first, second, register=False).pairs) == 1
+
+    saveLesions(second.id, [lesion(1, 101, 99), lesion(2, 500, 500)])
+    assert len(getLesionSet(getImage(second.id))["lesions"]) == 1
+    setModelVersion(second, "v2")
+    second = getImage(second.id)
+    assert len(getLesionSet(second)["lesions"]) == 2
+    assert matchImages(first, second, register=False).unmatchedB == [2]
+
+    invalidateLesions(second.id)
+    assert lesionCache.stats()["size"] == 1 and matchCache.stats()["size"] == 0
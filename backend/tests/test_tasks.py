@@ -0,0 +1,42 @@
+import pytest
+from sqlalchemy import update
+from bkg import celery_init_app
+from db import Image, getSession
+from service import Lesion, createImage, hasUntrackedLesions, saveLesions
+from tasks import enqueueTracking, lesionTaskStatus
+
+
+@pytest.fixture
+def celery(app):
+    app.config["CELERY"] = {
+        "broker_url": "memory://",
+        "result_backend": "cache+memory://",
+        "task_always_eager": True,
+        "task_store_eager_result": True,
+    }
+    return celery_init_app(app)
+
+
+def lesion(id, x, y):
+    return Lesion(id, 100, (y, x), (y - 5, x - 5, y + 5, x + 5), 0)
+
+
+def test_lesion_task_status_without_a_task(celery, patient):
+    img = createImage("key", patient.id, "hash")
+    assert lesionTaskStatus(img.id) == "PENDING"
+
+    # e.g. lesions copied from an identical upload, no task ever ran
+    with getSession() as session:
+        session.execute(update(Image).where(Image.id == img.id).values(lesionModelVersion="v1"))
+        session.commit()
+    assert lesionTaskStatus(img.id) == "SUCCESS"
+
+
+def test_enqueue_tracking_links_reused_lesions(celery, patient):
+    first = createImage("key-a", patient.id)
+    second = createImage("key-b", patient.id)
+    saveLesions(first.id, [lesion(1, 100, 100)])
+    saveLesions(second.id, [lesion(1, 101, 99)])
+
+    enqueueTracking(patient.id)
+    assert not hasUntrackedLesions(patient.id)